@@ -0,0 +1,83 @@
+import numpy as np
+
+
+# buttons which cancel each other, or select a single weapon, so pressing several of them at once is never useful
+OPPOSITE_BUTTONS = [
+    ["MOVE_LEFT", "MOVE_RIGHT"],
+    ["MOVE_FORWARD", "MOVE_BACKWARD"],
+    ["TURN_LEFT", "TURN_RIGHT"],
+    ["LOOK_UP", "LOOK_DOWN"],
+    ["MOVE_UP", "MOVE_DOWN"],
+    ["SELECT_WEAPON0", "SELECT_WEAPON1", "SELECT_WEAPON2", "SELECT_WEAPON3", "SELECT_WEAPON4", "SELECT_WEAPON5",
+     "SELECT_WEAPON6", "SELECT_WEAPON7", "SELECT_WEAPON8", "SELECT_WEAPON9", "SELECT_NEXT_WEAPON", "SELECT_PREV_WEAPON"]
+]
+
+
+class ActionSpace(object):
+    # the actions are integer codes with a bit per button, where the first button is the most significant bit. the
+    # valid codes are kept sorted, so without exclusive buttons the code of each action is its index, and the actions
+    # are in the same order as the boolean lists of it.product([False, True], repeat=num_buttons). the button vectors
+    # are decoded through a table which is computed once
+    def __init__(self, buttons, combine_actions=False, exclusive_buttons=None):
+        """
+        :param buttons: the names of the available buttons, or their number if the names are unknown
+        :param combine_actions: use all the valid combinations of buttons rather than a single button at a time
+        :param exclusive_buttons: groups of button names of which at most one can be pressed at a time. buttons which
+                                  are not available are ignored
+        """
+        if isinstance(buttons, int):
+            self.buttons, self.num_buttons = None, buttons
+        else:
+            self.buttons, self.num_buttons = [str(button).upper() for button in buttons], len(buttons)
+        if exclusive_buttons and self.buttons is None:
+            print("ERROR: exclusive buttons can't be used when the names of the buttons are unknown")
+            exit()
+        self.combine_actions = combine_actions
+        self.bits = np.left_shift(1, self.num_buttons - 1 - np.arange(self.num_buttons, dtype=np.int64))
+
+        if combine_actions:
+            # combine the options of each group - no button or a single button of the group - rather than filtering
+            # all the 2^num_buttons combinations
+            groups, grouped = [], set()
+            for group in exclusive_buttons or []:
+                idxs = [self.buttons.index(button) for button in group if button in self.buttons]
+                idxs = [idx for idx in idxs if idx not in grouped]
+                if len(idxs) > 1:
+                    groups.append(idxs)
+                    grouped.update(idxs)
+            groups += [[idx] for idx in range(self.num_buttons) if idx not in grouped]
+            codes = np.zeros(1, dtype=np.int64)
+            for idxs in groups:
+                options = np.concatenate([[0], self.bits[idxs]])
+                codes = (codes[:, None] | options[None, :]).reshape(-1)
+            self.codes = np.sort(codes)
+        else:
+            self.codes = self.bits.copy()
+        self.table = (self.codes[:, None] & self.bits[None, :]) != 0
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, action_idx):
+        # the button vector is passed to make_action as a list
+        return self.table[action_idx].tolist()
+
+    def decode(self, action_idxs):
+        """Decode a batch of actions to button vectors
+
+        :param action_idxs: the action indices
+        :return: the button vectors, shaped (len(action_idxs), num_buttons)
+        """
+        return self.table[np.asarray(action_idxs)]
+
+    def report(self):
+        """Count the actions and the memory they take
+
+        :return: a dictionary with the number of buttons, of all the button combinations and of the valid actions
+        """
+        return {
+            "buttons": self.num_buttons,
+            "combinations": 2 ** self.num_buttons if self.combine_actions else self.num_buttons,
+            "actions": len(self),
+            "bytes": self.codes.nbytes + self.table.nbytes
+        }
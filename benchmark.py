@@ -0,0 +1,343 @@
+import json
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from main import *
+
+
+def measure(function, min_time=1.0, min_calls=10):
+    """Call a function repeatedly for at least min_time seconds and at least min_calls times. the first call is not
+    measured, so compiling the backend functions and filling caches are not part of the results
+
+    :param function: the function to measure, called without arguments
+    :return: the number of calls and the elapsed time in seconds
+    """
+    function()
+    calls, start_time = 0, time.time()
+    while calls < min_calls or time.time() - start_time < min_time:
+        function()
+        calls += 1
+    return calls, time.time() - start_time
+
+
+def benchmark_result(name, params, calls, seconds, unit):
+    """Pack the measurement of a single benchmark. the name and the params identify the benchmark across commits
+
+    :param unit: what a single call counts as (e.g. ticks, frames, minibatches)
+    :return: the result as a dictionary
+    """
+    return {
+        "name": name,
+        "params": params,
+        "unit": unit,
+        "calls": calls,
+        "seconds": seconds,
+        "per_second": calls / seconds
+    }
+
+
+def random_transition(history_length, frame_shape, num_actions, game_over):
+    curr = np.random.randint(0, 256, (1, history_length) + frame_shape).astype(np.uint8)
+    next_state = [] if game_over else np.random.randint(0, 256, (1, history_length) + frame_shape).astype(np.uint8)
+    return Transition(curr, np.random.randint(num_actions), float(np.random.randint(2)), next_state)
+
+
+def fill_memory(memory, num_transitions, history_length, frame_shape, num_actions, episode_length=30):
+    # a small pool of random transitions is reused, creating them is much slower than storing them
+    pool = [random_transition(history_length, frame_shape, num_actions, False) for i in range(16)]
+    last = random_transition(history_length, frame_shape, num_actions, True)
+    for i in range(num_transitions):
+        game_over = (i + 1) % episode_length == 0
+        memory.remember(last if game_over else pool[i % len(pool)], game_over)
+
+
+def benchmark_environment_step(level, capture_mode, min_time, environment_backend=EnvironmentBackend.VIZDOOM,
+                               environment_args=None):
+    """Measure the ticks per second of the environment step with random actions. starting new episodes is included
+
+    :return: the benchmark result
+    """
+    environment = create_environment(environment_backend, level=level, combine_actions=True, visible=False,
+                                     capture_mode=capture_mode, environment_args=environment_args)
+    def step():
+        frame, reward, game_over = environment.step(environment.actions[np.random.randint(len(environment.actions))])
+        if game_over:
+            environment.new_episode()
+    calls, seconds = measure(step, min_time)
+    environment.close()
+    return benchmark_result("environment_step", {"level": level.name, "capture_mode": capture_mode.name,
+                                                 "environment_backend": environment_backend.name},
+                            calls, seconds, "ticks")
+
+
+def benchmark_replay(replay_memory, memory_size, prioritized, store_episodes, batch_size, history_length, min_time):
+    """Measure remember, sample_minibatch and sample_stacked_minibatch of a full experience replay filled with random
+    transitions. the stacked minibatches are only measured for replays of single transitions
+
+    :return: the benchmark results
+    """
+    frame_shape, num_actions = (image_height, image_width), 8
+    if replay_memory == ReplayMemory.FRAMES:
+        memory = FrameReplay(max_memory=memory_size, history_length=history_length, frame_shape=frame_shape,
+                             prioritized=prioritized)
+    else:
+        memory = ExperienceReplay(max_memory=memory_size, prioritized=prioritized, store_episodes=store_episodes)
+    fill_memory(memory, memory_size, history_length, frame_shape, num_actions)
+    params = {"replay_memory": replay_memory.name, "memory_size": memory_size, "prioritized": prioritized,
+              "store_episodes": store_episodes, "history_length": history_length}
+
+    # the memory is full, so each stored transition also evicts the oldest one
+    transition = random_transition(history_length, frame_shape, num_actions, False)
+    last = random_transition(history_length, frame_shape, num_actions, True)
+    steps = [0]
+    def remember(episode_length=30):
+        steps[0] += 1
+        game_over = steps[0] % episode_length == 0
+        memory.remember(last if game_over else transition, game_over)
+    calls, seconds = measure(remember, min_time)
+    results = [benchmark_result("replay_remember", params, calls, seconds, "transitions")]
+
+    calls, seconds = measure(lambda: memory.sample_minibatch(batch_size), min_time)
+    results.append(benchmark_result("replay_sample_minibatch", dict(params, batch_size=batch_size),
+                                    calls, seconds, "minibatches"))
+    if not store_episodes:
+        calls, seconds = measure(lambda: memory.sample_stacked_minibatch(batch_size), min_time)
+        results.append(benchmark_result("replay_sample_stacked_minibatch", dict(params, batch_size=batch_size),
+                                        calls, seconds, "minibatches"))
+    return results
+
+
+def benchmark_replay_insert_latency(memory_sizes, prioritized, store_episodes, min_time):
+    """Measure remember of full experience replays of increasing sizes. the states are a single pixel, so even the
+    largest replays fit in memory and the cost of copying the states doesn't hide the cost of the bookkeeping. the
+    latency of the uniform replay should not grow with the size of the replay. the prioritized replay also updates a
+    path of the sum tree per insert and eviction, so its latency grows with the depth of the tree
+
+    :param memory_sizes: the sizes of the replays
+    :return: the benchmark results, one per size
+    """
+    history_length, frame_shape, num_actions = 1, (1, 1), 8
+    params = {"replay_memory": ReplayMemory.TRANSITIONS.name, "prioritized": prioritized,
+              "store_episodes": store_episodes}
+    results = []
+    for memory_size in memory_sizes:
+        memory = ExperienceReplay(max_memory=memory_size, prioritized=prioritized, store_episodes=store_episodes)
+        # episodic records hold several transitions, so it takes more transitions to fill the memory
+        while len(memory) < memory_size:
+            fill_memory(memory, memory_size - len(memory), history_length, frame_shape, num_actions)
+        # the memory is full, so each stored transition also evicts the oldest record once a record is closed
+        transition = random_transition(history_length, frame_shape, num_actions, False)
+        last = random_transition(history_length, frame_shape, num_actions, True)
+        steps = [0]
+        def remember(episode_length=30):
+            steps[0] += 1
+            game_over = steps[0] % episode_length == 0
+            memory.remember(last if game_over else transition, game_over)
+        calls, seconds = measure(remember, min_time)
+        results.append(benchmark_result("replay_insert_latency", dict(params, memory_size=memory_size), calls, seconds,
+                                        "transitions"))
+        del memory
+    latencies = [result["seconds"] / result["calls"] for result in results]
+    print("insert latency from " + str(memory_sizes[0]) + " to " + str(memory_sizes[-1]) + " transitions: " +
+          str(round(1e6 * latencies[0], 2)) + " to " + str(round(1e6 * latencies[-1], 2)) + " us (x" +
+          str(round(latencies[-1] / latencies[0], 2)) + ")")
+    return results
+
+
+def benchmark_agent(args, min_time, train=True):
+    """Measure preprocess, predict, get_inputs_and_targets and train of an agent created from the given experiment
+    parameters. the experience replay is filled with random transitions
+
+    :param train: measure the training stages too
+    :return: the benchmark results
+    """
+    agent = create_agent(args)
+    params = {"architecture": agent.architecture.name, "algorithm": agent.algorithm.name,
+              "environment_backend": args["environment_backend"].name,
+              "replay_memory": args["replay_memory"].name, "prioritized": agent.memory.prioritized,
+              "batch_size": agent.batch_size}
+    fill_memory(agent.memory, args["max_memory"], agent.history_length, (agent.state_height, agent.state_width),
+                len(agent.environment.actions))
+    frame = agent.environment.get_curr_state()
+
+    calls, seconds = measure(lambda: agent.preprocess(frame), min_time)
+    results = [benchmark_result("agent_preprocess", {"capture_mode": agent.environment.capture_mode.name},
+                                calls, seconds, "frames")]
+
+    calls, seconds = measure(agent.predict, min_time)
+    results.append(benchmark_result("agent_predict", params, calls, seconds, "predictions"))
+    if not train:
+        agent.close()
+        return results
+
+    minibatch = agent.memory.sample_minibatch(agent.batch_size)
+    calls, seconds = measure(lambda: agent.get_inputs_and_targets(minibatch), min_time)
+    results.append(benchmark_result("agent_get_inputs_and_targets", params, calls, seconds, "minibatches"))
+
+    calls, seconds = measure(agent.train, min_time)
+    results.append(benchmark_result("agent_train", params, calls, seconds, "updates"))
+
+    agent.close()
+    return results
+
+
+def benchmark_target_update(args, min_time):
+    """Measure a hard and a soft update of the target network, both through numpy with get_weights and set_weights and
+    with the backend assign ops of the agent
+
+    :return: the benchmark results
+    """
+    agent = create_agent(args)
+    params = {"architecture": agent.architecture.name, "algorithm": agent.algorithm.name,
+              "num_weights": int(sum(np.prod(w.shape) for w in agent.online_network.get_weights()))}
+    def numpy_hard_update():
+        agent.target_network.set_weights(agent.online_network.get_weights())
+    def numpy_soft_update():
+        target_weights = agent.target_network.get_weights()
+        agent.target_network.set_weights([agent.tau * online + (1 - agent.tau) * target for online, target
+                                          in zip(agent.online_network.get_weights(), target_weights)])
+    hard_update, soft_update = agent.get_target_update_function(1), agent.get_target_update_function(agent.tau)
+    results = []
+    for mode, implementation, update in [("hard", "numpy", numpy_hard_update), ("hard", "backend", lambda: hard_update([])),
+                                         ("soft", "numpy", numpy_soft_update), ("soft", "backend", lambda: soft_update([]))]:
+        calls, seconds = measure(update, min_time)
+        results.append(benchmark_result("target_update", dict(params, mode=mode, implementation=implementation),
+                                        calls, seconds, "updates"))
+    agent.close()
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args):
+    """Run the whole benchmark suite
+
+    :param args: a dictionary containing the parameters of the suite
+    :return: the results and the machine and commit they were measured on
+    """
+    min_time = args["min_time"]
+    results = []
+    print("action spaces")
+    action_spaces = print_action_space_report(args["levels"])
+    for level in args["levels"]:
+        for capture_mode in args["capture_modes"]:
+            print("benchmarking environment step on " + level.name + " with capture mode " + capture_mode.name)
+            results.append(benchmark_environment_step(level, capture_mode, min_time, args["environment_backend"],
+                                                      args["environment_args"]))
+
+    for replay_memory, store_episodes in [(ReplayMemory.TRANSITIONS, False), (ReplayMemory.TRANSITIONS, True),
+                                          (ReplayMemory.FRAMES, False)]:
+        for prioritized in [False, True]:
+            for memory_size in args["memory_sizes"]:
+                print("benchmarking " + replay_memory.name + " experience replay with " + str(memory_size) +
+                      " transitions, prioritized " + str(prioritized) + ", episodic " + str(store_episodes))
+                results += benchmark_replay(replay_memory, memory_size, prioritized, store_episodes,
+                                            args["agent"]["batch_size"], args["agent"]["history_length"], min_time)
+
+    for store_episodes in [False, True]:
+        for prioritized in [False, True]:
+            print("benchmarking the insert latency of the experience replay, prioritized " + str(prioritized) +
+                  ", episodic " + str(store_episodes))
+            results += benchmark_replay_insert_latency(args["insert_latency_memory_sizes"], prioritized, store_episodes,
+                                                       min_time)
+
+    for architecture, algorithm in args["networks"]:
+        print("benchmarking agent with " + architecture.name + " architecture and " + algorithm.name)
+        agent_args = dict(args["agent"], architecture=architecture, algorithm=algorithm,
+                          environment_backend=args["environment_backend"], environment_args=args["environment_args"])
+        if architecture == Architecture.SEQUENCE:
+            agent_args.update(max_action_sequence_length=args["max_action_sequence_length"],
+                              replay_memory=ReplayMemory.TRANSITIONS)
+        if algorithm == Algorithm.DRQN:
+            agent_args.update(history_length=1)
+        # the training of DRQN is not implemented, only its predictions are measured
+        results += benchmark_agent(agent_args, min_time, train=(algorithm != Algorithm.DRQN))
+        results += benchmark_target_update(agent_args, min_time)
+
+    return {
+        "commit": get_commit(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "machine": {"platform": platform.platform(), "processor": platform.processor(),
+                    "python": platform.python_version(), "numpy": np.__version__, "backend": K.backend()},
+        "action_spaces": action_spaces,
+        "results": results
+    }
+
+
+def compare_results(baseline, current):
+    """Print the change in throughput of each benchmark relative to a baseline run
+
+    :param baseline: the results of the baseline run, as returned by run_benchmarks
+    :param current: the results of the current run
+    """
+    def key(result):
+        return result["name"] + " " + json.dumps(result["params"], sort_keys=True)
+    baseline_results = {key(result): result for result in baseline["results"]}
+    print("compared to commit " + str(baseline["commit"]))
+    for result in current["results"]:
+        if key(result) in baseline_results:
+            ratio = result["per_second"] / baseline_results[key(result)]["per_second"]
+            print(str(round(100 * (ratio - 1), 1)) + "% " + key(result))
+
+
+if __name__ == "__main__":
+    # usage: python benchmark.py [results.json] [baseline.json]
+    benchmark_args = {
+        "min_time": 2.0, # seconds each benchmark runs for
+        # the synthetic backend measures the agent and the learner without the cost of the engine
+        "environment_backend": EnvironmentBackend.VIZDOOM,
+        "environment_args": None,
+        "levels": [Level.BASIC, Level.HEALTH, Level.DEFEND, Level.DEATHMATCH],
+        "capture_modes": [CaptureMode.CONFIG, CaptureMode.FAST],
+        "memory_sizes": [1000, 10000, 50000],
+        "insert_latency_memory_sizes": [1000, 10000, 100000, 1000000], # with single pixel states
+        "max_action_sequence_length": 5,
+        "networks": [
+            (Architecture.DIRECT, Algorithm.DQN),
+            (Architecture.DIRECT, Algorithm.DDQN),
+            (Architecture.DIRECT, Algorithm.DRQN),
+            (Architecture.DUELING, Algorithm.DQN),
+            (Architecture.DUELING, Algorithm.DDQN),
+            (Architecture.SEQUENCE, Algorithm.DDQN)
+        ], # the dueling architecture is not implemented for DRQN, and the sequence architecture ignores the algorithm
+        "agent": {
+            "algorithm": Algorithm.DDQN,
+            "discount": 0.99,
+            "max_memory": 1000,
+            "prioritized_experience": False,
+            "exploration_policy": ExplorationPolicy.E_GREEDY,
+            "learning_rate": 2.5e-4,
+            "level": Level.BASIC,
+            "combine_actions": True,
+            "temperature": 10,
+            "batch_size": 10,
+            "history_length": 4,
+            "snapshot": '',
+            "mode": Mode.TRAIN,
+            "skipped_frames": 4,
+            "target_update_freq": 1000,
+            "epsilon_start": 0.5,
+            "epsilon_end": 0.01,
+            "epsilon_annealing_steps": 3e4,
+            "architecture": Architecture.DIRECT,
+            "max_action_sequence_length": 1,
+            "replay_memory": ReplayMemory.FRAMES
+        }
+    }
+
+    results = run_benchmarks(benchmark_args)
+    output_file = sys.argv[1] if len(sys.argv) > 1 else "benchmark_" + str(results["commit"])[:7] + ".json"
+    with open(output_file, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print("results saved to " + output_file)
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as baseline_file:
+            compare_results(json.load(baseline_file), results)
@@ -0,0 +1,166 @@
+import json
+import os
+import queue
+import shutil
+import threading
+import h5py
+from keras import backend as K
+
+
+def get_weights_copy(model):
+    """Copy the weights of a model together with the layer and weight names Keras stores them under
+
+    :param model: the model
+    :return: a list of (layer name, weight names, weight values) tuples, one per layer
+    """
+    layers = getattr(model, "flattened_layers", None) or model.layers
+    symbolic_weights = [layer.trainable_weights + layer.non_trainable_weights for layer in layers]
+    values = K.batch_get_value([weight for weights in symbolic_weights for weight in weights])
+    weights_copy, first = [], 0
+    for layer, weights in zip(layers, symbolic_weights):
+        names = [str(weight.name) if getattr(weight, "name", None) else "param_" + str(i) for i, weight in enumerate(weights)]
+        weights_copy.append((layer.name, names, values[first:first + len(weights)]))
+        first += len(weights)
+    return weights_copy
+
+
+def replace_atomically(path, write):
+    """Write a file through a temporary file which is renamed over the target, so the target is never left partially
+    written
+
+    :param path: the file to write
+    :param write: a function which writes the file given its path
+    """
+    temp_path = path + ".tmp"
+    write(temp_path)
+    with open(temp_path, "rb+") as temp_file:
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+
+
+def replace_directory_atomically(directory, write):
+    """Write a directory through a temporary directory which is renamed over the target. if the run is killed between
+    the two renames, the previous directory is left under the .old suffix, where find_directory looks for it
+
+    :param directory: the directory to write
+    :param write: a function which writes the contents of the directory given its path
+    """
+    temp_directory, old_directory = directory + ".tmp", directory + ".old"
+    if os.path.exists(temp_directory):
+        shutil.rmtree(temp_directory)
+    if os.path.exists(old_directory):
+        # left by an interrupted write, and the only complete copy if the directory itself is missing
+        if os.path.exists(directory):
+            shutil.rmtree(old_directory)
+        else:
+            os.rename(old_directory, directory)
+    os.makedirs(temp_directory)
+    write(temp_directory)
+    if os.path.exists(directory):
+        os.rename(directory, old_directory)
+    os.rename(temp_directory, directory)
+    if os.path.exists(old_directory):
+        shutil.rmtree(old_directory)
+
+
+def find_directory(directory):
+    """Find a directory written by replace_directory_atomically
+
+    :param directory: the directory
+    :return: the directory, or the previous version of it if the last write was interrupted, or None
+    """
+    for path in [directory, directory + ".old"]:
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+def write_weights(path, weights_copy):
+    """Write a copy of the weights in the HDF5 layout of Model.save_weights, so it is loaded by Model.load_weights
+
+    :param path: the file to write
+    :param weights_copy: the weights as returned by get_weights_copy
+    """
+    with h5py.File(path, "w") as f:
+        f.attrs["layer_names"] = [layer_name.encode("utf8") for layer_name, _, _ in weights_copy]
+        for layer_name, names, values in weights_copy:
+            group = f.create_group(layer_name)
+            group.attrs["weight_names"] = [name.encode("utf8") for name in names]
+            for name, value in zip(names, values):
+                dataset = group.create_dataset(name, value.shape, dtype=value.dtype)
+                dataset[:] = value
+
+
+class CheckpointWriter(object):
+    # writes snapshots of a model from a copy of its weights in a background thread, so saving does not stall acting
+    # and learning. each file is written atomically. once a snapshot is written, the snapshots which are neither among
+    # the last keep_last snapshots nor among the keep_best snapshots with the highest scores are deleted
+    def __init__(self, keep_last=None, keep_best=None, asynchronous=True, queue_depth=1):
+        """
+        :param keep_last: the number of most recent snapshots to keep. all the snapshots are kept if None
+        :param keep_best: the number of snapshots with the highest scores to keep, in addition to the last ones
+        :param queue_depth: the number of snapshots which can wait to be written, each holds a copy of the weights
+        """
+        self.keep_last = keep_last
+        self.keep_best = keep_best or 0
+        self.asynchronous = asynchronous
+        self.snapshots = [] # [snapshot, score] of the kept snapshots, oldest first
+        self.checkpoints = queue.Queue(maxsize=queue_depth)
+        if self.asynchronous:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def save(self, model, snapshot, score=None, capture_profile=None):
+        """Save a snapshot of the weights of a model. only copying the weights blocks when saving asynchronously
+
+        :param model: the model
+        :param snapshot: the snapshot file
+        :param score: the score which ranks the snapshot for the retention (e.g. the average return)
+        :param capture_profile: the capture profile of the environment, written next to the snapshot
+        """
+        checkpoint = (snapshot, get_weights_copy(model), score, capture_profile)
+        if self.asynchronous:
+            self.checkpoints.put(checkpoint)
+        else:
+            self.write(*checkpoint)
+
+    def run(self):
+        while True:
+            checkpoint = self.checkpoints.get()
+            if checkpoint is None:
+                return
+            try:
+                self.write(*checkpoint)
+            except Exception as e:
+                print("ERROR: failed to save snapshot " + checkpoint[0] + " - " + str(e))
+
+    def write(self, snapshot, weights_copy, score, capture_profile):
+        replace_atomically(snapshot, lambda path: write_weights(path, weights_copy))
+        if capture_profile is not None:
+            def write_capture_profile(path):
+                with open(path, "w") as profile_file:
+                    json.dump(capture_profile, profile_file)
+            replace_atomically(snapshot + ".json", write_capture_profile)
+        self.snapshots = [kept for kept in self.snapshots if kept[0] != snapshot] + [[snapshot, score]]
+        self.apply_retention()
+
+    def apply_retention(self):
+        if self.keep_last is None:
+            return
+        kept = self.snapshots[-self.keep_last:] if self.keep_last > 0 else []
+        scored = [snapshot for snapshot in self.snapshots if snapshot[1] is not None]
+        best = sorted(scored, key=lambda snapshot: snapshot[1], reverse=True)[:self.keep_best]
+        for snapshot in self.snapshots:
+            if snapshot not in kept and snapshot not in best:
+                for path in [snapshot[0], snapshot[0] + ".json"]:
+                    if os.path.exists(path):
+                        os.remove(path)
+        self.snapshots = [snapshot for snapshot in self.snapshots if snapshot in kept or snapshot in best]
+
+    def close(self):
+        """Wait until all the snapshots are written"""
+        if self.asynchronous:
+            self.checkpoints.put(None)
+            self.thread.join()
+            self.asynchronous = False
@@ -0,0 +1,61 @@
+import numpy as np
+
+
+def linear_schedule(step, start, end, num_steps):
+    """Anneal a value linearly from start to end over num_steps steps and keep it at end afterwards
+
+    :param step: the step, or an array of steps
+    :return: the value at each step
+    """
+    fraction = np.minimum(np.asarray(step, dtype=np.float64) / float(num_steps), 1.0)
+    return start + fraction * (end - start)
+
+
+def sample_proportional(weights):
+    """Sample an index from each row of non-negative weights, proportionally to the weights. rows which sum to zero
+    are sampled uniformly
+
+    :param weights: the weights, shaped (batch, actions)
+    :return: the sampled indices, shaped (batch,)
+    """
+    weights = np.where(np.sum(weights, axis=1, keepdims=True) > 0, weights, 1.0)
+    thresholds = np.cumsum(weights, axis=1)
+    values = np.random.rand(len(weights), 1) * thresholds[:, -1:]
+    return np.minimum(np.sum(thresholds <= values, axis=1), weights.shape[1] - 1)
+
+
+def e_greedy(Q, epsilon):
+    """Choose the action with the max Q value, or a random action with probability epsilon
+
+    :param Q: the Q values, shaped (batch, actions)
+    :param epsilon: the probability of a random action, a single value or one per row
+    :return: the action indices, shaped (batch,)
+    """
+    random_actions = np.random.randint(Q.shape[1], size=len(Q))
+    return np.where(np.random.rand(len(Q)) < epsilon, random_actions, np.argmax(Q, axis=1))
+
+
+def softmax(Q, temperature):
+    """Sample the actions with prob(a) = e^(Q(a)/temp)/sum(e^(Q(a)/temp))
+
+    :param Q: the Q values, shaped (batch, actions)
+    :return: the action indices, shaped (batch,)
+    """
+    # the max is subtracted so the exponent can't overflow, the probabilities don't change
+    exp_Q = np.exp((Q - np.max(Q, axis=1, keepdims=True)) / float(temperature))
+    return sample_proportional(exp_Q)
+
+
+def shifted_multinomial(Q, average_minimum):
+    """Sample the actions proportionally to Q(a) - min(average_minimum, min(Q)), where the average minimum is a running
+    average of the minimal Q value. the average is updated once for the whole batch, with the mean of the minima
+
+    :param Q: the Q values, shaped (batch, actions)
+    :param average_minimum: the running average of the minimal Q value
+    :return: the action indices, shaped (batch,) and the updated average minimum
+    """
+    minima = np.min(Q, axis=1)
+    decay = 0.95 ** len(Q)
+    average_minimum = decay * average_minimum + (1 - decay) * np.mean(minima)
+    shifted_Q = Q - np.minimum(average_minimum, minima)[:, None]
+    return sample_proportional(shifted_Q), average_minimum
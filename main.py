@@ -10,13 +10,28 @@ from keras.initializations import uniform
 from keras.layers.advanced_activations import LeakyReLU, ELU
 from keras.preprocessing.sequence import pad_sequences
 from keras import backend as K
-from vizdoom import *
-import scipy.ndimage
+try:
+    from vizdoom import *
+except ImportError:
+    DoomGame = None # only the synthetic and trace environment backends can be used
 from time import sleep
+import time
+import queue
 import matplotlib.pyplot as plt
-import itertools as it
 import datetime
+import json
+import os
+import multiprocessing
+import threading
 from enum import Enum
+from preprocessing import FramePreprocessor, FrameStack, Resampling
+from actions import ActionSpace, OPPOSITE_BUTTONS
+from profiling import Profiler, format_profile
+from metrics import MetricsFormat, MetricsLogger, read_metric
+from exploration import e_greedy, linear_schedule, shifted_multinomial, softmax
+from checkpoint import CheckpointWriter, find_directory, get_weights_copy, replace_directory_atomically, write_weights
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 image_height, image_width = 60, 80 #TODO: change to 72
@@ -39,6 +54,13 @@ def vec_to_one_hot(vec):
 def batch_to_one_hot(batch):
     return [vec_to_one_hot(vec)[0] for vec in batch]
 
+def create_preprocessor(screen_height, screen_width, resampling=Resampling.BILINEAR):
+    # resize image and convert to greyscale. frames which are resized are stretched to [0, 255] and stored as uint8
+    # like scipy.misc.imresize used to do
+    scale = image_width / float(screen_width)
+    return FramePreprocessor(screen_height, screen_width, int(screen_height * scale), image_width,
+                             bytescale=(scale != 1), dtype=(np.uint8 if scale != 1 else np.float32), resampling=resampling)
+
 class Mode(Enum):
     TRAIN = 1
     TEST = 2
@@ -66,6 +88,19 @@ class ExplorationPolicy(Enum):
     SOFTMAX = 2
     SHIFTED_MULTINOMIAL = 3
 
+class ReplayMemory(Enum):
+    TRANSITIONS = 1
+    FRAMES = 2
+
+class CaptureMode(Enum):
+    CONFIG = 1 # screen format, resolution and rendering as defined in the level config
+    FAST = 2 # greyscale at the smallest resolution which covers the network input, without unused rendering features
+
+class EnvironmentBackend(Enum):
+    VIZDOOM = 1
+    SYNTHETIC = 2 # random frames and rewards with the screen and buttons of the level, without running the game
+    TRACE = 3 # replays the frames and rewards recorded by record_trace
+
 class MaskedEmbedding(Embedding):
     def __init__(self, mask_value=0, **kwargs):
         self.mask_value=mask_value
@@ -76,25 +111,171 @@ class MaskedEmbedding(Embedding):
         return K.not_equal(x, self.mask_value)
 
 
+def get_smallest_covering_resolution(height, width):
+    """Find the smallest screen resolution supported by ViZDoom which covers the given size and has the same aspect ratio
+
+    :return: the name of the screen resolution
+    """
+    resolutions = []
+    for name in dir(ScreenResolution):
+        if not name.startswith("RES_"):
+            continue
+        screen_width, screen_height = [int(size) for size in name[len("RES_"):].split("X")]
+        if screen_width >= width and screen_height >= height and screen_width * height == screen_height * width:
+            resolutions.append((screen_width * screen_height, name))
+    return min(resolutions)[1]
+
+
+def load_capture_profile(snapshot):
+    """Load the capture profile which was recorded alongside a snapshot
+
+    :param snapshot: the snapshot file
+    :return: the capture profile, or None for snapshots saved without one
+    """
+    if not os.path.exists(snapshot + ".json"):
+        return None
+    with open(snapshot + ".json") as profile_file:
+        return json.load(profile_file)
+
+
+def get_snapshot_capture_mode(snapshot, capture_mode):
+    """Get the capture mode an environment should use to match the frames a snapshot was trained on
+
+    :param snapshot: the snapshot file, or '' if none is loaded
+    :param capture_mode: the requested capture mode
+    :return: the capture mode of the snapshot, or the requested one for snapshots saved without a capture profile
+    """
+    if snapshot != '':
+        capture_profile = load_capture_profile(snapshot)
+        if capture_profile is not None and CaptureMode[capture_profile["capture_mode"]] != capture_mode:
+            print("Warning: snapshot was trained with capture mode " + capture_profile["capture_mode"])
+            return CaptureMode[capture_profile["capture_mode"]]
+    return capture_mode
+
+
+def read_level_config(level):
+    """Read the values of a ViZDoom level config. ViZDoom accepts both underscore and camel notation for the keys, so
+    the keys are lowercased and the underscores are removed
+
+    :param level: the level
+    :return: a dictionary of the values as strings, or as lists of strings for values in braces
+    """
+    config, key, block = {}, None, None
+    with open(level.value) as config_file:
+        for line in config_file:
+            line = line.split("#")[0].replace("{", " { ").replace("}", " } ")
+            if block is None and "=" in line:
+                key, value = [part.strip() for part in line.split("=", 1)]
+                key = key.replace("_", "").lower()
+                if value == "" or value.startswith("{"):
+                    block, line = [], value
+                else:
+                    config[key] = value
+                    continue
+            if block is not None:
+                for token in line.split():
+                    if token == "}":
+                        config[key], block = block, None
+                        break
+                    elif token != "{":
+                        block.append(token)
+    return config
+
+
+def create_environment(backend=EnvironmentBackend.VIZDOOM, level=Level.BASIC, combine_actions=False, visible=True,
+                       capture_mode=CaptureMode.CONFIG, environment_args=None, exclusive_buttons=None):
+    """Create an environment using the given backend. all the backends have the same interface as Environment
+
+    :param environment_args: additional arguments of the synthetic or trace environment
+    :param exclusive_buttons: groups of buttons of which at most one is pressed by each combined action
+    :return: the environment
+    """
+    environment_args = environment_args or {}
+    if backend == EnvironmentBackend.SYNTHETIC:
+        return SyntheticEnvironment(level=level, combine_actions=combine_actions, capture_mode=capture_mode,
+                                    exclusive_buttons=exclusive_buttons, **environment_args)
+    elif backend == EnvironmentBackend.TRACE:
+        return TraceEnvironment(combine_actions=combine_actions, capture_mode=capture_mode,
+                                exclusive_buttons=exclusive_buttons, **environment_args)
+    return Environment(level=level, combine_actions=combine_actions, visible=visible, capture_mode=capture_mode,
+                       exclusive_buttons=exclusive_buttons)
+
+
+class EnvironmentSpec(object):
+    # describes an environment to an agent which acts in it without owning it, e.g. an environment shared by the agents
+    # of an entity. the agent needs only its actions, the size of its frames and its capture profile
+    def __init__(self, actions, screen_width, screen_height, capture_profile):
+        self.actions = actions
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.capture_profile = capture_profile
+
+
+def get_environment_spec(environment, actions=None):
+    """Describe an environment
+
+    :param environment: the environment
+    :param actions: the actions of the agent, if they are not the actions of the environment
+    :return: the environment spec
+    """
+    return EnvironmentSpec(actions if actions is not None else environment.actions, environment.screen_width,
+                           environment.screen_height, environment.capture_profile)
+
+
+def print_action_space_report(levels, exclusive_buttons=OPPOSITE_BUTTONS):
+    """Print the number of actions of each level with single buttons, with all the combinations of buttons and with
+    the combinations which don't press exclusive buttons together
+
+    :param levels: the levels
+    :return: the reports of the action spaces of each level
+    """
+    reports = {}
+    for level in levels:
+        buttons = read_level_config(level)["availablebuttons"]
+        reports[level.name] = {
+            "single": ActionSpace(buttons).report(),
+            "combined": ActionSpace(buttons, combine_actions=True).report(),
+            "exclusive": ActionSpace(buttons, combine_actions=True, exclusive_buttons=exclusive_buttons).report()
+        }
+        print(level.name + ": buttons = " + str(len(buttons)) + " combined actions = " +
+              str(reports[level.name]["combined"]["actions"]) + " with exclusive buttons = " +
+              str(reports[level.name]["exclusive"]["actions"]) + " (" +
+              str(reports[level.name]["exclusive"]["bytes"]) + " bytes)")
+    return reports
+
+
 class Environment(object):
-    def __init__(self, level = Level.BASIC, combine_actions = False, visible = True):
+    def __init__(self, level = Level.BASIC, combine_actions = False, visible = True, capture_mode = CaptureMode.CONFIG,
+                 exclusive_buttons = None):
+        if DoomGame is None:
+            print("ERROR: ViZDoom is not installed, only the synthetic and trace environment backends are available")
+            exit()
         self.game = DoomGame()
         self.game.load_config(level.value)
         self.game.set_window_visible(visible)
+        self.capture_mode = capture_mode
+        if capture_mode == CaptureMode.FAST:
+            # the agent only uses a small greyscale frame, so avoid rendering and copying anything else
+            self.game.set_screen_format(ScreenFormat.GRAY8)
+            self.game.set_screen_resolution(getattr(ScreenResolution, get_smallest_covering_resolution(image_height, image_width)))
+            self.game.set_render_hud(False)
+            self.game.set_render_crosshair(False)
+            self.game.set_render_particles(False)
+            self.game.set_render_decals(False)
         self.game.init()
         self.actions_num = self.game.get_available_buttons_size()
         self.combine_actions = combine_actions
-        self.actions = []
-        if self.combine_actions:
-            for perm in it.product([False, True], repeat=self.actions_num):
-                self.actions.append(list(perm))
-        else:
-            for action in range(self.actions_num):
-                one_hot = [False] * self.actions_num
-                one_hot[action] = True
-                self.actions.append(one_hot)
+        self.actions = ActionSpace([str(button).split(".")[-1] for button in self.game.get_available_buttons()],
+                                   combine_actions, exclusive_buttons)
         self.screen_width = self.game.get_screen_width()
         self.screen_height = self.game.get_screen_height()
+        # recorded alongside each snapshot, so a snapshot is tested with the frames it was trained on
+        self.capture_profile = {
+            "capture_mode": capture_mode.name,
+            "screen_format": str(self.game.get_screen_format()),
+            "screen_width": self.screen_width,
+            "screen_height": self.screen_height
+        }
 
     def step(self, action):
         reward = self.game.make_action(action)
@@ -111,23 +292,268 @@ class Environment(object):
     def is_game_over(self):
         return self.game.is_episode_finished()
 
+    def close(self):
+        self.game.close()
+
+
+class SyntheticEnvironment(object):
+    # generates frames and rewards instead of running the game. the buttons, screen size, episode length and living
+    # reward are taken from the level config. the frames and rewards depend only on the seed, so runs are deterministic
+    # and the agent and the learner can be benchmarked without the cost of the engine
+    def __init__(self, level=Level.BASIC, combine_actions=False, capture_mode=CaptureMode.CONFIG, episode_length=None,
+                 living_reward=None, reward=100, reward_probability=0.01, num_frames=32, seed=0, exclusive_buttons=None):
+        """
+        :param episode_length: the number of steps in each episode, the episode timeout of the level by default
+        :param living_reward: the reward for each step, the living reward of the level by default
+        :param reward: an additional reward which is given with probability reward_probability on each step
+        :param num_frames: the number of random frames which are cycled through
+        """
+        config = read_level_config(level)
+        self.actions_num = len(config["availablebuttons"])
+        self.combine_actions = combine_actions
+        self.actions = ActionSpace(config["availablebuttons"], combine_actions, exclusive_buttons)
+        self.capture_mode = capture_mode
+        if capture_mode == CaptureMode.FAST:
+            screen_format = "ScreenFormat.GRAY8"
+            self.screen_width, self.screen_height = image_width * 2, image_height * 2 # RES_160X120 like Environment
+        else:
+            screen_format = "ScreenFormat." + config.get("screenformat", "CRCGCB")
+            self.screen_width, self.screen_height = [int(size) for size in
+                                                     config.get("screenresolution", "RES_320X240")[4:].split("X")]
+        if screen_format == "ScreenFormat.GRAY8":
+            frame_shape = (self.screen_height, self.screen_width)
+        else:
+            frame_shape = (3, self.screen_height, self.screen_width)
+        self.capture_profile = {
+            "capture_mode": capture_mode.name,
+            "screen_format": screen_format,
+            "screen_width": self.screen_width,
+            "screen_height": self.screen_height
+        }
+
+        self.episode_length = episode_length if episode_length is not None else int(config.get("episodetimeout", 300))
+        self.living_reward = living_reward if living_reward is not None else float(config.get("livingreward", 0))
+        self.reward = reward
+        self.reward_probability = reward_probability
+        self.random = np.random.RandomState(seed)
+        self.frames = self.random.randint(0, 256, (num_frames,) + frame_shape).astype(np.uint8)
+        self.frame_idx = 0
+        self.episode_step = 0
+
+    def step(self, action):
+        self.episode_step += 1
+        self.frame_idx = (self.frame_idx + 1) % len(self.frames)
+        reward = self.living_reward
+        if self.random.rand() < self.reward_probability:
+            reward += self.reward
+        return self.frames[self.frame_idx], reward, self.is_game_over()
+
+    def get_curr_state(self):
+        return self.frames[self.frame_idx]
+
+    def new_episode(self):
+        self.episode_step = 0
+
+    def is_game_over(self):
+        return self.episode_step >= self.episode_length
+
+    def close(self):
+        pass
+
+
+class TraceEnvironment(object):
+    # replays the frames and rewards recorded by record_trace, ignoring the actions. the trace is replayed from the start
+    # once it is over, and the last recorded step always ends the episode
+    def __init__(self, trace_file, combine_actions=False, capture_mode=None, exclusive_buttons=None):
+        """
+        :param trace_file: the .npz file written by record_trace
+        :param capture_mode: the frames are replayed as they were recorded, so this only warns about a mismatch
+        """
+        trace = np.load(trace_file)
+        self.frames = trace["frames"]
+        self.rewards = trace["rewards"]
+        self.game_overs = trace["game_overs"]
+        self.game_overs[-1] = True
+        self.episode_starts = np.concatenate([[0], np.flatnonzero(self.game_overs[:-1]) + 1])
+        self.actions_num = int(trace["actions_num"])
+        self.combine_actions = combine_actions
+        # the names of the buttons are not known for traces recorded before they were stored
+        buttons = json.loads(str(trace["buttons"])) if "buttons" in trace.files else None
+        self.actions = ActionSpace(buttons if buttons is not None else self.actions_num, combine_actions,
+                                   exclusive_buttons)
+        self.capture_profile = json.loads(str(trace["capture_profile"]))
+        self.capture_mode = CaptureMode[self.capture_profile["capture_mode"]]
+        if capture_mode is not None and capture_mode != self.capture_mode:
+            print("Warning: the trace was recorded with capture mode " + self.capture_mode.name)
+        self.screen_width = self.capture_profile["screen_width"]
+        self.screen_height = self.capture_profile["screen_height"]
+        self.position = 0
+
+    def step(self, action):
+        self.position += 1
+        return self.frames[self.position], float(self.rewards[self.position]), bool(self.game_overs[self.position])
+
+    def get_curr_state(self):
+        return self.frames[self.position]
+
+    def new_episode(self):
+        # nothing to do if no step was made since the beginning of the episode
+        if self.position in self.episode_starts:
+            return
+        next_starts = self.episode_starts[self.episode_starts > self.position]
+        self.position = next_starts[0] if len(next_starts) > 0 else 0
+
+    def is_game_over(self):
+        return bool(self.game_overs[self.position])
+
+    def close(self):
+        pass
+
+
+def record_trace(environment, trace_file, num_steps):
+    """Play random actions in an environment and record the frames and rewards, to be replayed by TraceEnvironment
+
+    :param environment: the environment to record
+    :param trace_file: the .npz file to write
+    :param num_steps: the number of steps to record
+    """
+    environment.new_episode()
+    frames, rewards, game_overs = [environment.get_curr_state()], [0], [False]
+    for step in range(num_steps):
+        frame, reward, game_over = environment.step(environment.actions[np.random.randint(len(environment.actions))])
+        if game_over:
+            # there is no frame after the end of the episode
+            frame = np.zeros_like(frames[-1])
+        frames.append(frame)
+        rewards.append(reward)
+        game_overs.append(game_over)
+        if game_over and step < num_steps - 1:
+            environment.new_episode()
+            frames.append(environment.get_curr_state())
+            rewards.append(0)
+            game_overs.append(False)
+    np.savez(trace_file, frames=np.array(frames), rewards=np.array(rewards, dtype=np.float32),
+             game_overs=np.array(game_overs, dtype=np.bool_), actions_num=environment.actions_num,
+             buttons=json.dumps(environment.actions.buttons),
+             capture_profile=json.dumps(environment.capture_profile))
+
+
+def environment_worker(connection, level, combine_actions, skipped_frames, resampling=Resampling.BILINEAR,
+                       capture_mode=CaptureMode.CONFIG, environment_backend=EnvironmentBackend.VIZDOOM,
+                       environment_args=None, exclusive_buttons=None):
+    """Run a single environment in a worker process. the worker repeats each action for skipped_frames frames, starts a
+    new episode when the current one is finished and replies with the preprocessed frame
+
+    :param connection: the worker end of the pipe to the VectorEnvironment
+    """
+    environment = create_environment(environment_backend, level=level, combine_actions=combine_actions, visible=False,
+                                     capture_mode=capture_mode, environment_args=environment_args,
+                                     exclusive_buttons=exclusive_buttons)
+    preprocess = create_preprocessor(environment.screen_height, environment.screen_width, resampling)
+    while True:
+        command, data = connection.recv()
+        if command == "step":
+            reward, game_over = 0, False
+            for t in range(skipped_frames):
+                frame, r, game_over = environment.step(environment.actions[data])
+                reward += r # reward is accumulated
+                if game_over:
+                    break
+            # on game over the frame of the new episode is sent so the agent can start a new state with it
+            if game_over:
+                environment.new_episode()
+            connection.send((preprocess(environment.get_curr_state()), reward, game_over))
+        elif command == "reset":
+            environment.new_episode()
+            connection.send(preprocess(environment.get_curr_state()))
+        elif command == "spec":
+            connection.send((environment.actions, environment.screen_width, environment.screen_height,
+                             environment.capture_profile))
+        elif command == "close":
+            environment.close()
+            connection.close()
+            break
+
+
+class VectorEnvironment(object):
+    # runs several DoomGame instances in worker processes and steps all of them with a batch of actions
+    def __init__(self, num_environments, level=Level.BASIC, combine_actions=False, skipped_frames=4,
+                 resampling=Resampling.BILINEAR, capture_mode=CaptureMode.CONFIG,
+                 environment_backend=EnvironmentBackend.VIZDOOM, environment_args=None, exclusive_buttons=None):
+        self.num_environments = num_environments
+        self.connections = []
+        self.processes = []
+        for i in range(num_environments):
+            worker_environment_args = environment_args
+            if environment_backend == EnvironmentBackend.SYNTHETIC:
+                # each synthetic environment generates different frames and rewards
+                worker_environment_args = dict(environment_args or {})
+                worker_environment_args["seed"] = worker_environment_args.get("seed", 0) + i
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=environment_worker,
+                                              args=(worker_connection, level, combine_actions, skipped_frames, resampling,
+                                                    capture_mode, environment_backend, worker_environment_args,
+                                                    exclusive_buttons))
+            process.daemon = True
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+        self.connections[0].send(("spec", None))
+        self.actions, self.screen_width, self.screen_height, self.capture_profile = self.connections[0].recv()
+
+    def reset(self, environment_idxs=None):
+        """Start a new episode in the given environments
+
+        :param environment_idxs: the environments to reset, all of them by default
+        :return: the preprocessed first frames of the new episodes
+        """
+        if environment_idxs is None:
+            environment_idxs = range(self.num_environments)
+        for idx in environment_idxs:
+            self.connections[idx].send(("reset", None))
+        return np.array([self.connections[idx].recv() for idx in environment_idxs])
+
+    def step(self, action_idxs):
+        """Perform one action in each environment. the environments are stepped in parallel
+
+        :param action_idxs: the index of the action to perform in each environment
+        :return: the preprocessed frames, the rewards and the game over flags. when an environment finished its episode
+                 the frame is the first frame of the new episode
+        """
+        for connection, action_idx in zip(self.connections, action_idxs):
+            connection.send(("step", int(action_idx)))
+        frames, rewards, game_overs = zip(*[connection.recv() for connection in self.connections])
+        return np.array(frames), np.array(rewards, dtype=np.float32), np.array(game_overs, dtype=np.bool_)
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(("close", None))
+        for process in self.processes:
+            process.join()
+
 
 class Agent(object):
     def __init__(self, discount, level, algorithm, prioritized_experience, max_memory, exploration_policy,
                  learning_rate, history_length, batch_size, combine_actions, target_update_freq, epsilon_start, epsilon_end,
                  epsilon_annealing_steps, temperature=10, snapshot='', train=True, visible=True, skipped_frames=4,
-                 architecture=Architecture.DIRECT, max_action_sequence_length=1):
+                 architecture=Architecture.DIRECT, max_action_sequence_length=1, replay_memory=ReplayMemory.TRANSITIONS,
+                 prefetch_minibatches=True, prefetch_queue_depth=2, frame_resampling=Resampling.BILINEAR,
+                 capture_mode=CaptureMode.CONFIG, environment_backend=EnvironmentBackend.VIZDOOM, environment_args=None,
+                 profiler=None, snapshots_keep_last=None, snapshots_keep_best=None, asynchronous_snapshots=True,
+                 incremental_target_update=False, exclusive_buttons=None, environment_spec=None, frame_store=None,
+                 max_memory_bytes=None):
 
         self.trainable = train
+        self.profiler = profiler if profiler is not None else Profiler(enabled=False)
 
-        # e-greedy policy
+        # e-greedy policy. epsilon is a function of the number of actions selected so far
         self.epsilon_annealing_steps = epsilon_annealing_steps #steps
         self.epsilon_start = epsilon_start
         self.epsilon_end = epsilon_end
-        if self.trainable:
-            self.epsilon = self.epsilon_start
-        else:
-            self.epsilon = self.epsilon_end
+        self.exploration_step = 0
+        self.epsilon = self.get_epsilon(self.exploration_step)
 
         # softmax / multinomial policy
         self.average_minimum = 0 # for multinomial policy
@@ -136,19 +562,33 @@ class Agent(object):
         self.policy = exploration_policy
 
         # initialization
-        self.environment = Environment(level=level, combine_actions=combine_actions, visible=visible)
-        self.memory = ExperienceReplay(max_memory=max_memory, prioritized=prioritized_experience, store_episodes=(max_action_sequence_length>1))
-        self.preprocessed_curr = []
+        if environment_spec is not None:
+            # the agent acts in an environment it doesn't own (e.g. the entity's), which feeds it the frames
+            self.environment = None
+            if snapshot != '' and load_capture_profile(snapshot) not in [None, environment_spec.capture_profile]:
+                print("Warning: snapshot was trained with capture profile " + str(load_capture_profile(snapshot)))
+        else:
+            # use the capture mode the snapshot was trained with
+            capture_mode = get_snapshot_capture_mode(snapshot, capture_mode)
+            self.environment = create_environment(environment_backend, level=level, combine_actions=combine_actions,
+                                                  visible=visible, capture_mode=capture_mode,
+                                                  environment_args=environment_args, exclusive_buttons=exclusive_buttons)
+            environment_spec = get_environment_spec(self.environment)
+        self.environment_spec = environment_spec
+        self.actions = environment_spec.actions
         self.win_count = 0
         self.curr_step = 0
+        self.target_step = 0 # the last step the target network was updated for
 
         self.state_width = image_width
         self.state_height = image_height
-        self.scale = self.state_width / float(self.environment.screen_width)
+        self.scale = self.state_width / float(environment_spec.screen_width)
+        self.preprocessor = create_preprocessor(environment_spec.screen_height, environment_spec.screen_width,
+                                                frame_resampling)
 
         # recurrent
         self.max_action_sequence_length = max_action_sequence_length
-        self.num_actions = len(self.environment.actions)
+        self.num_actions = len(self.actions)
         self.input_action_space_size = self.num_actions + 2 # number of actions + start and end (padding) tokens
         self.output_action_space_size = self.num_actions
         self.start_token = self.num_actions
@@ -157,13 +597,55 @@ class Agent(object):
         # training
         self.discount = discount
         self.history_length = history_length # should be 1 for DRQN
+        # the current state. the network input and the transitions are views into it
+        self.frame_stack = FrameStack(history_length, self.preprocessor.output_height, self.preprocessor.output_width,
+                                      self.preprocessor.dtype)
         self.skipped_frames = skipped_frames
         self.learning_rate = learning_rate
         self.batch_size = batch_size
         self.target_update_freq = target_update_freq
-        self.incremental_target_update = False
+        self.incremental_target_update = incremental_target_update # soft (polyak) updates instead of copies
         self.increment_each_num_steps = 10
         self.tau = 30/float(self.target_update_freq)
+        self.target_update_functions = {} # tau -> backend function, built on the first update
+        # serializes the train steps and the updates of the online and target networks, which an entity makes from
+        # its learner thread, with the other threads which read them. the entity's loop acts with a copy of the online
+        # network (see create_acting_network), so it doesn't wait for the train steps
+        self.network_lock = threading.Lock()
+
+        # experience replay
+        if replay_memory == ReplayMemory.FRAMES:
+            if self.max_action_sequence_length > 1:
+                print("ERROR: frames replay memory supports only single transitions")
+                exit()
+            if max_memory_bytes is not None:
+                print("ERROR: the frames replay memory is preallocated, its size is set by max_memory only")
+                exit()
+            self.memory = FrameReplay(max_memory=max_memory, history_length=self.history_length,
+                                      frame_shape=(self.state_height, self.state_width), prioritized=prioritized_experience,
+                                      frame_store=frame_store)
+            # the agents which share the frame store share its lock
+            self.memory_lock = self.memory.store.lock
+        else:
+            if frame_store is not None:
+                print("ERROR: a shared frame store requires the frames replay memory")
+                exit()
+            # stored episodes can be arbitrarily long, so the number of records doesn't bound the memory use
+            self.memory = ExperienceReplay(max_memory=max_memory, prioritized=prioritized_experience,
+                                           store_episodes=(self.max_action_sequence_length>1), max_bytes=max_memory_bytes)
+            self.memory_lock = threading.Lock()
+
+        # minibatches are sampled and stacked in a worker thread while the agent acts and trains. the prefetcher is
+        # started on the first train step, once the experience replay is not empty
+        self.prefetch_minibatches = prefetch_minibatches # set to False to prepare the minibatches synchronously
+        self.prefetch_queue_depth = prefetch_queue_depth
+        self.prefetcher = None
+
+        # snapshots are written from a copy of the weights in a worker thread, which is started on the first snapshot
+        self.snapshots_keep_last = snapshots_keep_last # all the snapshots are kept if None
+        self.snapshots_keep_best = snapshots_keep_best
+        self.asynchronous_snapshots = asynchronous_snapshots
+        self.checkpoint_writer = None
 
         self.algorithm = algorithm
         self.architecture = architecture
@@ -176,6 +658,10 @@ class Agent(object):
             self.online_network.load_weights(snapshot)
             self.target_network.compile(adam(lr=self.learning_rate), "mse")
             self.online_network.compile(adam(lr=self.learning_rate), "mse")
+        # the network the agent predicts its actions with. it is the online network unless the agent trains in
+        # another thread than it acts
+        self.acting_network = self.online_network
+        self.acting_update_function = None
         """
         self.target_network, self.state_encoder, self.target_state_decoder = self.autoencoder()
         self.online_network, _, self.online_state_decoder = self.autoencoder()
@@ -244,7 +730,7 @@ class Agent(object):
         _state_value = state_value(_state_value)
         __state_value = state_value(__state_value)
         state_value = Lambda(lambda s: K.expand_dims(s[:, 0], dim=-1),
-                             output_shape=(len(self.environment.actions),))
+                             output_shape=(len(self.actions),))
         _state_value = state_value(_state_value)
         __state_value = state_value(__state_value)
 
@@ -252,11 +738,11 @@ class Agent(object):
         action_advantage = Dense(256, activation='relu', init='uniform')
         _action_advantage = action_advantage(encoded_state)
         __action_advantage = action_advantage(input_encoded_state)
-        action_advantage = Dense(len(self.environment.actions), init='uniform')
+        action_advantage = Dense(len(self.actions), init='uniform')
         _action_advantage = action_advantage(_action_advantage)
         __action_advantage = action_advantage(__action_advantage)
         action_advantage = Lambda(lambda a: a[:, :] - K.mean(a[:, :], keepdims=True),
-                                  output_shape=(len(self.environment.actions),))
+                                  output_shape=(len(self.actions),))
         _action_advantage = action_advantage(_action_advantage)
         __action_advantage = action_advantage(__action_advantage)
 
@@ -289,7 +775,7 @@ class Agent(object):
                 output1 = merge([tower_1, tower_2, tower_3], mode='concat', concat_axis=1)
                 avgpool = AveragePooling2D((7, 7), strides=(8, 8))(output1)
                 flatten = Flatten()(avgpool)
-                output = Dense(len(self.environment.actions))(flatten)
+                output = Dense(len(self.actions))(flatten)
                 model = Model(input=input_img, output=output)
                 model.compile(rmsprop(lr=self.learning_rate), "mse")
                 #model.summary()
@@ -303,7 +789,7 @@ class Agent(object):
                 model.add(Convolution2D(256, 3, 3, subsample=(1,1), activation='relu', init='uniform'))
                 model.add(Flatten())
                 model.add(Dense(512, activation='relu', init='uniform'))
-                model.add(Dense(len(self.environment.actions),init='uniform'))
+                model.add(Dense(len(self.actions),init='uniform'))
                 model.compile(rmsprop(lr=self.learning_rate), "mse")
             elif network_type == "recurrent":
                 print("Built a recurrent DQN")
@@ -315,7 +801,7 @@ class Agent(object):
                 model.add(TimeDistributed(Convolution2D(256, 3, 3, subsample=(1,1), activation='relu', init='uniform')))
                 model.add(TimeDistributed(Flatten()))
                 model.add(LSTM(512, activation='relu', init='uniform', unroll=True))
-                model.add(Dense(len(self.environment.actions),init='uniform'))
+                model.add(Dense(len(self.actions),init='uniform'))
                 model.compile(rmsprop(lr=self.learning_rate), "mse")
                 #model.summary()
         elif architecture == Architecture.DUELING:
@@ -333,11 +819,11 @@ class Agent(object):
                 # state value tower - V
                 state_value = Dense(256, activation='relu', init='uniform')(x)
                 state_value = Dense(1, init='uniform')(state_value)
-                state_value = Lambda(lambda s: K.expand_dims(s[:, 0], dim=-1), output_shape=(len(self.environment.actions),))(state_value)
+                state_value = Lambda(lambda s: K.expand_dims(s[:, 0], dim=-1), output_shape=(len(self.actions),))(state_value)
                 # action advantage tower - A
                 action_advantage = Dense(256, activation='relu', init='uniform')(x)
-                action_advantage = Dense(len(self.environment.actions), init='uniform')(action_advantage)
-                action_advantage = Lambda(lambda a: a[:, :] - K.mean(a[:, :], keepdims=True), output_shape=(len(self.environment.actions),))(action_advantage)
+                action_advantage = Dense(len(self.actions), init='uniform')(action_advantage)
+                action_advantage = Lambda(lambda a: a[:, :] - K.mean(a[:, :], keepdims=True), output_shape=(len(self.actions),))(action_advantage)
                 # merge to state-action value function Q
                 state_action_value = merge([state_value, action_advantage], mode='sum')
                 model = Model(input=input, output=state_action_value)
@@ -369,7 +855,7 @@ class Agent(object):
             model = Sequential()
             model.add(Merge([state_model, action_model], mode='concat', concat_axis=-1))
             model.add(LSTM(512, return_sequences=True, activation='relu', init='uniform'))
-            model.add(TimeDistributed(Dense(len(self.environment.actions), init='uniform')))
+            model.add(TimeDistributed(Dense(len(self.actions), init='uniform')))
             model.compile(rmsprop(lr=self.learning_rate), "mse")
             model.summary()
             """
@@ -397,11 +883,11 @@ class Agent(object):
             # state value tower - V
             state_value = TimeDistributed(Dense(256, activation='relu', init='uniform'))(x)
             state_value = TimeDistributed(Dense(1, init='uniform'))(state_value)
-            state_value = Lambda(lambda s: K.repeat_elements(s,rep=len(self.environment.actions),axis=2))(state_value)
+            state_value = Lambda(lambda s: K.repeat_elements(s,rep=len(self.actions),axis=2))(state_value)
 
             # action advantage tower - A
             action_advantage = TimeDistributed(Dense(256, activation='relu', init='uniform'))(x)
-            action_advantage = TimeDistributed(Dense(len(self.environment.actions), init='uniform'))(action_advantage)
+            action_advantage = TimeDistributed(Dense(len(self.actions), init='uniform'))(action_advantage)
             action_advantage = TimeDistributed(Lambda(lambda a: a - K.mean(a, keepdims=True, axis=-1)))(action_advantage)
 
             # merge to state-action value function Q
@@ -413,87 +899,127 @@ class Agent(object):
 
         return model
 
-    def preprocess(self, state):
-        # resize image and convert to greyscale
-        if self.scale == 1:
-            return np.mean(state,0)
-        else:
-            state = scipy.misc.imresize(np.mean(state,0), self.scale)
-            #state = np.lib.pad(state, ((6, 6), (0, 0)), 'constant', constant_values=(0)) #TODO: remove comment
-            return state
+    def preprocess(self, state, out=None):
+        with self.profiler.phase("preprocess"):
+            return self.preprocessor(state, out)
 
-    def get_inputs_and_targets_for_sequence(self, minibatch):
-        """Given a minibatch, extract the inputs and targets for the training according to DQN or DDQN
-
-                :param minibatch: the minibatch to train on
-                :return: the inputs, targets and sample weights (for prioritized experience replay)
-                """
-        # if self.architecture == Architecture.SEQUENCE:
-        #    return self.get_inputs_and_targets_for_sequence(minibatch)
-
-        targets = list()
-        action_idxs = list()
-        inputs = list()
-        samples_weights = list()
-        for idx, transition_list, game_over, sample_weight in minibatch:
+    def stack_sequence_minibatch(self, minibatch):
+        """Choose a random subsequence from each record of a minibatch and pad the subsequences into fixed shape arrays
 
+        :param minibatch: the minibatch as sampled from the experience replay
+        :return: the record ids, current states, input action tokens, chosen actions, chosen rewards, positions mask,
+                 next states, bootstrap flags, last rewards and sample weights
+        """
+        batch_size = len(minibatch)
+        sequence_length = self.max_action_sequence_length
+
+        # padded per position arrays. positions after the end of the chosen subsequence are masked out
+        chosen_actions = np.zeros((batch_size, sequence_length), dtype=np.int64)
+        chosen_rewards = np.zeros((batch_size, sequence_length), dtype=np.float32)
+        mask = np.zeros((batch_size, sequence_length), dtype=np.bool_)
+        input_actions = np.full((batch_size, sequence_length), self.end_token, dtype=np.int64)
+        input_actions[:, 0] = self.start_token
+        bootstrap = np.ones(batch_size, dtype=np.bool_)
+        last_rewards = np.zeros(batch_size, dtype=np.float32)
+        curr_states, next_states = list(), list()
+        for i, (record_idx, transition_list, game_over, sample_weight) in enumerate(minibatch):
             # choose random end transition from the episode
             end_idx = np.random.randint(0, len(transition_list))
-            start_idx = max(0, end_idx - self.max_action_sequence_length + 1)
+            start_idx = max(0, end_idx - sequence_length + 1)
 
-            # there should be at least one chosen transition)
+            # there should be at least one chosen transition
             chosen_transitions = transition_list[start_idx:end_idx+1]
             num_chosen_transitions = len(chosen_transitions)
-            first_transition = chosen_transitions[0]
-            last_transition = chosen_transitions[-1]
+            chosen_actions[i, :num_chosen_transitions] = [transition.action for transition in chosen_transitions]
+            chosen_rewards[i, :num_chosen_transitions] = [transition.reward for transition in chosen_transitions]
+            mask[i, :num_chosen_transitions] = True
+            input_actions[i, 1:num_chosen_transitions] = chosen_actions[i, :num_chosen_transitions-1]
 
-            # relevant actions
-            chosen_actions = [transition.action for transition in chosen_transitions]
-            input_actions = [self.start_token] + chosen_actions[:-1]
-            # pad in the end if necessary
-            if len(input_actions) < self.max_action_sequence_length:
-                input_actions += [self.end_token] * (self.max_action_sequence_length - num_chosen_transitions)
-            actions_for_next_state = [self.start_token] + [self.end_token] * (self.max_action_sequence_length - 1)
+            # the last transition of a finished episode is not bootstrapped from its (missing) next state
+            curr_states.append(chosen_transitions[0].preprocessed_curr)
+            if game_over and end_idx == len(transition_list)-1:
+                bootstrap[i] = False
+                last_rewards[i] = chosen_transitions[-1].reward
+                next_states.append(chosen_transitions[0].preprocessed_curr) # placeholder, masked later
+            else:
+                next_states.append(chosen_transitions[-1].preprocessed_next)
+        curr_states = np.concatenate(curr_states)
+        next_states = np.concatenate(next_states)
+        idxs = [record[0] for record in minibatch]
+        samples_weights = np.array([record[3] for record in minibatch], dtype=np.float32)
 
-            # prepare input for predicting the current and next actions
-            curr_input = [first_transition.preprocessed_curr, np.array([input_actions])]
-            next_input = [last_transition.preprocessed_next, np.array([actions_for_next_state])]
+        return (idxs, curr_states, input_actions, chosen_actions, chosen_rewards, mask, next_states, bootstrap,
+                last_rewards, samples_weights)
 
-            action_idxs.append(input_actions)
-            inputs.append(curr_input[0][0])
+    def get_inputs_and_targets_for_sequence(self, minibatch):
+        """Given a minibatch, extract the inputs and targets for the training according to DQN or DDQN
 
-            # get the current action-values
-            target = self.online_network.predict(curr_input)[0]
+        :param minibatch: the minibatch to train on
+        :return: the inputs, targets and sample weights (for prioritized experience replay)
+        """
+        return self.get_sequence_targets(self.stack_sequence_minibatch(minibatch))
 
-            # calculate TD-target for last transition
-            next_value = 0
-            if game_over and end_idx == len(transition_list)-1:
-                next_value = last_transition.reward
-            else:
-                if self.algorithm == Algorithm.DQN:
-                    Q_sa = self.target_network.predict(next_input)[0][0]
-                    next_value = np.max(Q_sa)
+    def get_sequence_targets(self, batch):
+        """Given a stacked minibatch of subsequences, calculate the targets for the training according to DQN or DDQN.
+        the whole minibatch is evaluated with a single forward pass of each network
+
+        :param batch: the minibatch as returned by stack_sequence_minibatch
+        :return: the inputs, targets and sample weights (for prioritized experience replay)
+        """
+        (idxs, curr_states, input_actions, chosen_actions, chosen_rewards, mask, next_states, bootstrap,
+         last_rewards, samples_weights) = batch
+        batch_size, sequence_length = input_actions.shape
+        actions_for_next_state = np.full((batch_size, sequence_length), self.end_token, dtype=np.int64)
+        actions_for_next_state[:, 0] = self.start_token
+
+        # get the current action-values and the values of the next states
+        if self.algorithm == Algorithm.DDQN:
+            Q = self.online_network.predict([np.concatenate([curr_states, next_states]),
+                                             np.concatenate([input_actions, actions_for_next_state])], batch_size=2*batch_size)
+            targets, next_online_Q = Q[:batch_size], Q[batch_size:, 0]
+            best_next_actions = np.argmax(next_online_Q, axis=1)
+            next_target_Q = self.target_network.predict([next_states, actions_for_next_state], batch_size=batch_size)[:, 0]
+            next_values = next_target_Q[np.arange(batch_size), best_next_actions]
+        else:
+            targets = self.online_network.predict([curr_states, input_actions], batch_size=batch_size)
+            next_target_Q = self.target_network.predict([next_states, actions_for_next_state], batch_size=batch_size)[:, 0]
+            next_values = np.max(next_target_Q, axis=1)
+        next_values = np.where(bootstrap, next_values, last_rewards)
+
+        # calculate TD-targets for all the chosen transitions at once
+        TD_targets = chosen_rewards + self.discount * next_values[:, None]
+        TD_errors = TD_targets[:, 0] - targets[np.arange(batch_size), 0, chosen_actions[:, 0]]
+        sample_idxs, positions = np.nonzero(mask)
+        targets[sample_idxs, positions, chosen_actions[sample_idxs, positions]] = TD_targets[sample_idxs, positions]
+
+        # updates priority and weight for prioritized experience replay
+        if self.memory.prioritized:
+            with self.memory_lock:
+                self.memory.update_transition_priorities(idxs, np.abs(TD_errors))
+        else:
+            samples_weights = np.array([])
 
-                elif self.algorithm == Algorithm.DDQN:
-                    best_next_action = np.argmax(self.online_network.predict(next_input)[0][0])
-                    next_value = self.target_network.predict(next_input)[0][0][best_next_action]
+        return curr_states, targets, samples_weights, input_actions
 
-            current_index = min(self.max_action_sequence_length, num_chosen_transitions) - 1
-            for idx in range(current_index,-1,-1):
-                transition = chosen_transitions[idx]
-                TD_target = transition.reward + self.discount * next_value
-                TD_error = TD_target - target[idx][transition.action]
-                target[idx][transition.action] = TD_target
+    def stack_minibatch(self, minibatch):
+        """Stack the transitions of a minibatch of single transitions into arrays
 
-            targets.append(target)
+        :param minibatch: the minibatch as sampled from the experience replay
+        :return: the indices, current states, actions, rewards, next states, game over flags and sample weights
+        """
+        idxs = [record[0] for record in minibatch]
+        transitions = [record[1][0] for record in minibatch]
+        game_overs = np.array([record[2] for record in minibatch], dtype=np.bool_)
+        samples_weights = np.array([record[3] for record in minibatch], dtype=np.float32)
 
-            # updates priority and weight for prioritized experience replay
-            if self.memory.prioritized:
-                self.memory.update_transition_priority(idx, np.abs(TD_error))
-                samples_weights.append(sample_weight)
+        curr_states = np.concatenate([transition.preprocessed_curr for transition in transitions])
+        # terminal transitions have no next state, so their current state is used as a placeholder which is masked later
+        next_states = np.concatenate([transition.preprocessed_curr if game_over else transition.preprocessed_next
+                                      for transition, game_over in zip(transitions, game_overs)])
+        actions = np.array([transition.action for transition in transitions], dtype=np.int64)
+        rewards = np.array([transition.reward for transition in transitions], dtype=np.float32)
 
-        #print(action_idxs)
-        return np.array(inputs), np.array(targets), np.array(samples_weights), np.array(action_idxs)
+        return idxs, curr_states, actions, rewards, next_states, game_overs, samples_weights
 
     def get_inputs_and_targets(self, minibatch):
         """Given a minibatch, extract the inputs and targets for the training according to DQN or DDQN
@@ -503,116 +1029,75 @@ class Agent(object):
         """
         if self.architecture == Architecture.SEQUENCE:
             return self.get_inputs_and_targets_for_sequence(minibatch)
+        return self.get_targets(self.stack_minibatch(minibatch))
 
-        targets = list()
-        action_idxs = list()
-        inputs = list()
-        samples_weights = list()
-        for idx, transition_list, game_over, sample_weight in minibatch:
-            # for episodic experience - choose a random ending action
-            transition = transition_list[0]
-            inputs.append(transition.preprocessed_curr[0])
+    def get_targets(self, batch):
+        """Given a stacked minibatch, calculate the targets for the training according to DQN or DDQN. the whole
+        minibatch is evaluated with a single forward pass of each network
 
-            # prepare input for predicting the current and next actions
-            curr_input = transition.preprocessed_curr
-            next_input = transition.preprocessed_next
+        :param batch: the minibatch as returned by stack_minibatch
+        :return: the inputs, targets and sample weights (for prioritized experience replay)
+        """
+        idxs, curr_states, actions, rewards, next_states, game_overs, samples_weights = batch
+        batch_size = len(actions)
+
+        # get the current action-values and the values of the next states
+        if self.algorithm == Algorithm.DDQN:
+            Q = self.online_network.predict(np.concatenate([curr_states, next_states]), batch_size=2*batch_size)
+            targets, next_online_Q = Q[:batch_size], Q[batch_size:]
+            best_next_actions = np.argmax(next_online_Q, axis=1)
+            next_values = self.target_network.predict(next_states, batch_size=batch_size)[np.arange(batch_size), best_next_actions]
+        else:
+            targets = self.online_network.predict(curr_states, batch_size=batch_size)
+            next_values = np.max(self.target_network.predict(next_states, batch_size=batch_size), axis=1)
 
-            # get the current action-values
-            target = self.online_network.predict(curr_input)[0]
+        # calculate TD-targets, terminal states have no next value
+        TD_targets = np.where(game_overs, rewards, rewards + self.discount * next_values)
+        TD_errors = TD_targets - targets[np.arange(batch_size), actions]
+        targets[np.arange(batch_size), actions] = TD_targets
 
-            # calculate TD-target for last transition
-            if game_over:
-                TD_target = transition.reward
-            else:
-                if self.algorithm == Algorithm.DQN:
-                    Q_sa = self.target_network.predict(next_input)
-                    TD_target = transition.reward + self.discount * np.max(Q_sa)
-
-                elif self.algorithm == Algorithm.DDQN:
-                    best_next_action = np.argmax(self.online_network.predict(next_input))
-                    Q_sa = self.target_network.predict(next_input)[0][best_next_action]
-                    TD_target = transition.reward + self.discount * Q_sa
-
-            TD_error = TD_target - target[transition.action]
-            target[transition.action] = TD_target
-            targets.append(target)
-
-            # updates priority and weight for prioritized experience replay
-            if self.memory.prioritized:
-                self.memory.update_transition_priority(idx, np.abs(TD_error))
-                samples_weights.append(sample_weight)
-
-        return np.array(inputs), np.array(targets), np.array(samples_weights), np.array(action_idxs)
-
-    def softmax_selection(self, Q):
-        """Select the action according to the softmax exploration policy
-
-        :param Q: the Q values for the current state
-        :return: the action and the action index
-        """
-        # compute thresholds and choose a random number
-        exp_Q = np.array(np.exp(Q/float(self.temperature)), copy=True)
-        prob = np.random.rand(1)
-        importances = [action_value/float(np.sum(exp_Q)) for action_value in exp_Q]
-        thresholds = np.cumsum(importances)
-        # multinomial sampling according to priorities
-        for action_idx, threshold in zip(range(len(thresholds)), thresholds):
-            if prob < threshold:
-                action = self.environment.actions[action_idx]
-                return action, action_idx
-        return self.environment.actions[len(exp_Q)-1], len(exp_Q)-1
-
-    def shifted_multinomial_selection(self, Q):
-        """Select the action according to a shifted multinomial sampling policy
-
-        :param Q: the Q values of the current state
-        :return: the action and the action index
-        """
-        # Q values are shifted so that we won't have negative values
-        self.average_minimum = 0.95 * self.average_minimum + 0.05 * np.min(Q)
-        shifted_Q = np.array(Q - min(self.average_minimum, np.min(Q)), copy=True)
-        # compute thresholds and choose a random number
-        prob = np.random.rand(1)
-        importances = [action_value/float(np.sum(shifted_Q)) for action_value in shifted_Q]
-        thresholds = np.cumsum(importances)
-        # multinomial sampling according to priorities
-        for action_idx, threshold in zip(range(len(thresholds)), thresholds):
-            if prob < threshold:
-                action = self.environment.actions[action_idx]
-                return action, action_idx
-
-    def e_greedy(self, Q):
-        """ Select the action according to the e-greedy exploration policy
-
-        :param Q: the Q values for the current state
-        :return: the action and the action index
-        """
-        # choose action randomly or greedily
-        coin_toss = np.random.rand(1)[0]
-        if coin_toss > self.epsilon:
-            action_idx = np.argmax(Q)
+        # updates priority and weight for prioritized experience replay
+        if self.memory.prioritized:
+            with self.memory_lock:
+                self.memory.update_transition_priorities(idxs, np.abs(TD_errors))
         else:
-            action_idx = np.random.randint(len(self.environment.actions))
-        action = self.environment.actions[action_idx]
+            samples_weights = np.array([])
 
-        # anneal epsilon value
-        if self.epsilon > self.epsilon_end:
-            self.epsilon -= float(self.epsilon_start - self.epsilon_end)/float(self.epsilon_annealing_steps)
+        return curr_states, targets, samples_weights, np.array([])
 
-        return action, action_idx
+    def get_epsilon(self, step):
+        """Get the epsilon of the e-greedy policy after a given number of selected actions
 
-    def get_action_according_to_exploration_policy(self, Q):
-        action, action_idx = self.environment.actions[0], 0
+        :param step: the number of actions selected before, or an array of them
+        :return: epsilon
+        """
+        epsilon_start = self.epsilon_start if self.trainable else self.epsilon_end
+        return linear_schedule(step, epsilon_start, self.epsilon_end, self.epsilon_annealing_steps)
+
+    def select_actions(self, Q):
+        """Select an action for each of a batch of Q value vectors according to the exploration policy
+
+        :param Q: the Q values, shaped (batch, actions)
+        :return: the action indices
+        """
+        Q = np.reshape(Q, (-1, self.num_actions))
         if self.policy == ExplorationPolicy.E_GREEDY:
-            action, action_idx = self.e_greedy(Q)
+            # epsilon is annealed for each action of the batch, as if they were selected one after the other
+            action_idxs = e_greedy(Q, self.get_epsilon(self.exploration_step + np.arange(len(Q))))
         elif self.policy == ExplorationPolicy.SHIFTED_MULTINOMIAL:
-            action, action_idx = self.shifted_multinomial_selection(Q)
+            action_idxs, self.average_minimum = shifted_multinomial(Q, self.average_minimum)
         elif self.policy == ExplorationPolicy.SOFTMAX:
-            action, action_idx = self.softmax_selection(Q)
+            action_idxs = softmax(Q, self.temperature)
         else:
             print("Error: exploration policy not available")
             exit()
-        return action, action_idx
+        self.exploration_step += len(Q)
+        self.epsilon = float(self.get_epsilon(self.exploration_step))
+        return action_idxs
+
+    def get_action_according_to_exploration_policy(self, Q):
+        action_idx = int(self.select_actions(Q)[0])
+        return self.actions[action_idx], action_idx
 
     def predict_sequence(self):
         """predict action according to the current state
@@ -621,14 +1106,11 @@ class Agent(object):
         """
         # if no current state is present, create one by stacking the duplicated current state
 
-        if self.preprocessed_curr == []:
-            frame = self.environment.get_curr_state()
-            preprocessed_frame = self.preprocess(frame)
-            for t in range(self.history_length):
-                self.preprocessed_curr.append(preprocessed_frame)
+        if self.frame_stack.empty:
+            self.frame_stack.reset(self.preprocess(self.environment.get_curr_state()))
 
         # choose action
-        preprocessed_curr = np.reshape(self.preprocessed_curr, (1, self.history_length, self.state_height, self.state_width))
+        preprocessed_curr = self.frame_stack.current()
 
         actions = []
         action_idxs = []
@@ -636,7 +1118,7 @@ class Agent(object):
         curr_idx = 1
         input_actions = [self.start_token] + [self.end_token] * (self.max_action_sequence_length-1)
         for idx in range(1,self.max_action_sequence_length+1):
-            Q = self.online_network.predict([preprocessed_curr, np.array([input_actions])], batch_size=1)[0]
+            Q = self.acting_network.predict([preprocessed_curr, np.array([input_actions])], batch_size=1)[0]
             action_value = Q[idx-1]
             if idx > 1 and np.max(action_value) < last_max_Q:
                 break
@@ -655,40 +1137,55 @@ class Agent(object):
         :return: the action, the action index, the mean Q value
         """
         # if no current state is present, create one by stacking the duplicated current state
-        if self.architecture == Architecture.SEQUENCE:
-            return self.predict_sequence()
+        with self.profiler.phase("predict"):
+            if self.architecture == Architecture.SEQUENCE:
+                return self.predict_sequence()
 
-        if self.preprocessed_curr == []:
-            frame = self.environment.get_curr_state()
-            preprocessed_frame = self.preprocess(frame)
-            for t in range(self.history_length):
-                self.preprocessed_curr.append(preprocessed_frame)
+            if self.frame_stack.empty:
+                self.frame_stack.reset(self.preprocess(self.environment.get_curr_state()))
 
-        # choose action
-        preprocessed_curr = np.reshape(self.preprocessed_curr, (1, self.history_length, self.state_height, self.state_width))
-        if self.algorithm == Algorithm.DRQN:
-            # expand dims to have a time dimension + switch between depth and time
-            preprocessed_curr = np.expand_dims(preprocessed_curr, axis=0).transpose(0,2,1,3,4)
+            # choose action
+            preprocessed_curr = self.frame_stack.current()
+            if self.algorithm == Algorithm.DRQN:
+                # expand dims to have a time dimension + switch between depth and time
+                preprocessed_curr = np.expand_dims(preprocessed_curr, axis=0).transpose(0,2,1,3,4)
 
-        # predict a single action
-        Q = self.online_network.predict(preprocessed_curr, batch_size=1)
-        action, action_idx = self.get_action_according_to_exploration_policy(Q)
+            # predict a single action
+            Q = self.acting_network.predict(preprocessed_curr, batch_size=1)
+            action, action_idx = self.get_action_according_to_exploration_policy(Q)
 
-        return [action], [action_idx], np.max(Q) # send as a list of actions to conform with episodic experience replay
+            return [action], [action_idx], np.max(Q) # send as a list of actions to conform with episodic experience replay
+
+    def predict_batch(self, preprocessed_currs):
+        """predict actions for a batch of states (e.g. one per environment) with a single forward pass
+
+        :param preprocessed_currs: the current states, shaped (batch, history_length, height, width)
+        :return: the actions, the action indices, the max Q values
+        """
+        with self.profiler.phase("predict"):
+            if self.algorithm == Algorithm.DRQN:
+                # add a depth dimension for the time distributed layers
+                preprocessed_currs = np.expand_dims(preprocessed_currs, axis=2)
+
+            Q = self.acting_network.predict(preprocessed_currs, batch_size=len(preprocessed_currs))
+            action_idxs = self.select_actions(Q)
+            actions = [self.actions[action_idx] for action_idx in action_idxs]
+
+            return actions, action_idxs, np.max(Q, axis=1)
 
     def step(self, action, action_idx):
         # repeat action several times and stack the first frame onto the previous state
         reward = 0
         game_over = False
-        preprocessed_next = list(self.preprocessed_curr)
-        del preprocessed_next[0]
         for t in range(self.skipped_frames):
-            frame, r, game_over = self.environment.step(action)
+            with self.profiler.phase("environment_step"):
+                frame, r, game_over = self.environment.step(action)
             reward += r # reward is accumulated
             if game_over:
                 break
             if t == self.skipped_frames-1: # rest are skipped
-                preprocessed_next.append(self.preprocess(frame))
+                # only the new frame is returned. it is preprocessed directly into the frame stack
+                preprocessed_next = self.preprocess(frame, out=self.frame_stack.next_frame())
 
         # episode finished
         if game_over:
@@ -699,49 +1196,384 @@ class Agent(object):
 
         return preprocessed_next, reward, game_over
 
-    def store_next_state(self, preprocessed_next, reward, game_over, action_idx):
-        preprocessed_curr = np.reshape(self.preprocessed_curr, (1, self.history_length, image_height, image_width))
-        self.preprocessed_curr = list(preprocessed_next) # saved as list
-        if preprocessed_next != []:
-            preprocessed_next = np.reshape(preprocessed_next, (1, self.history_length, image_height, image_width))
+    def make_transition(self, preprocessed_next, reward, action_idx):
+        """Create the transition from the current state to the next state and move on to the next state. the states of
+        the transition are views into the frame stack, so they should be copied if they are kept after the next step
 
+        :param preprocessed_next: the new preprocessed frame as returned by step, or [] if the episode finished
+        :return: the transition
+        """
+        if len(preprocessed_next) == 0:
+            preprocessed_curr = self.frame_stack.current()
+            self.frame_stack.clear()
+            return Transition(preprocessed_curr, action_idx, reward, [])
+        self.frame_stack.push(preprocessed_next)
+        return Transition(self.frame_stack.previous(), action_idx, reward, self.frame_stack.current())
+
+    def start_episode(self, frame):
+        """Start the state of a new episode from its first frame, for agents which don't own their environment
+
+        :param frame: the first frame of the episode
+        """
+        self.frame_stack.reset(self.preprocess(frame))
+
+    def store_frame(self, frame, reward, game_over, action_idx, truncated=False):
+        """Store the transition to a new frame of an environment the agent doesn't own
+
+        :param frame: the new frame, ignored if the episode finished
+        :param truncated: is the episode cut off after this step? the next episode starts with start_episode
+        """
+        preprocessed_next = [] if game_over else self.preprocess(frame, out=self.frame_stack.next_frame())
+        return self.store_next_state(preprocessed_next, reward, game_over, action_idx, truncated)
+
+    def store_next_state(self, preprocessed_next, reward, game_over, action_idx, truncated=False):
         # store transition
-        self.memory.remember(Transition(preprocessed_curr, action_idx, reward, preprocessed_next), game_over) # stored as np array
+        with self.profiler.phase("store_next_state"):
+            self.remember(self.make_transition(preprocessed_next, reward, action_idx), game_over, truncated) # stored as np array
+
+        return reward, game_over
+
+    def store_next_states(self, preprocessed_currs, preprocessed_nexts, rewards, game_overs, action_idxs):
+        """Store a batch of transitions coming from several environments
+
+        :param preprocessed_currs: the current states, shaped (batch, history_length, height, width)
+        :param preprocessed_nexts: the next states, ignored for terminal transitions
+        :param rewards: the rewards
+        :param game_overs: are the next states terminal states?
+        :param action_idxs: the indices of the actions taken
+        """
+        with self.profiler.phase("store_next_state"):
+            for i in range(len(action_idxs)):
+                game_over = bool(game_overs[i])
+                preprocessed_next = [] if game_over else preprocessed_nexts[i:i+1]
+                self.remember(Transition(preprocessed_currs[i:i+1], int(action_idxs[i]), rewards[i], preprocessed_next),
+                              game_over)
+
+    def remember(self, transition, game_over, truncated=False):
+        # the experience replay may be sampled concurrently by the minibatch prefetcher
+        with self.memory_lock:
+            self.memory.remember(transition, game_over, truncated)
 
         self.curr_step += 1
+        # an agent which trains in another thread than it acts updates its target network from the learner thread, so
+        # storing a transition doesn't wait for a train step
+        if self.acting_network is self.online_network:
+            with self.network_lock:
+                self.update_target_network(self.curr_step)
+            self.target_step = self.curr_step
+
+    def get_target_update_function(self, tau):
+        """Build a backend function which sets the target network to tau*online + (1-tau)*target with assign ops, so the
+        weights are updated in place without being copied through numpy
+
+        :param tau: the weight of the online network. 1 copies the online network
+        :return: the function, called with an empty list of inputs
+        """
+        if tau not in self.target_update_functions:
+            online_weights = self.online_network.trainable_weights + self.online_network.non_trainable_weights
+            target_weights = self.target_network.trainable_weights + self.target_network.non_trainable_weights
+            if tau == 1:
+                updates = [K.update(target, online) for target, online in zip(target_weights, online_weights)]
+            else:
+                updates = [K.update(target, tau * online + (1 - tau) * target)
+                           for target, online in zip(target_weights, online_weights)]
+            self.target_update_functions[tau] = K.function([], [], updates=updates)
+        return self.target_update_functions[tau]
 
-        # update target network with online network once in a while
+    def update_target_network(self, step):
+        """Update the target network with the online network once in a while. called with the network lock held
+
+        :param step: the number of transitions stored so far
+        """
         if self.incremental_target_update:
-            if self.curr_step % self.increment_each_num_steps == 0:
-                #print(">>> update the target")
-                online_weights = self.online_network.get_weights()
-                target_weights = self.target_network.get_weights()
-                for i in xrange(len(online_weights)):
-                    #print(online_weights[i].shape)
-                    #print(target_weights[i].shape)
-
-                    target_weights[i] = self.tau * online_weights[i] + (1 - self.tau) * target_weights[i]
-                self.target_network.set_weights(target_weights)
+            if step % self.increment_each_num_steps == 0:
+                with self.profiler.phase("target_sync"):
+                    self.get_target_update_function(self.tau)([])
         else:
-            if self.curr_step % self.target_update_freq == 0:
+            if step % self.target_update_freq == 0:
                 print(">>> update the target")
-                self.target_network.set_weights(self.online_network.get_weights())
+                with self.profiler.phase("target_sync"):
+                    self.get_target_update_function(1)([])
 
-        return reward, game_over
+    def create_acting_network(self):
+        """Act with a copy of the online network, for agents which train in another thread than they act. predicting
+        then doesn't wait for the train steps, and the copy is synced with the online network after each of them
+        """
+        self.acting_network = self.create_network(architecture=self.architecture, algorithm=self.algorithm)
+        online_weights = self.online_network.trainable_weights + self.online_network.non_trainable_weights
+        acting_weights = self.acting_network.trainable_weights + self.acting_network.non_trainable_weights
+        self.acting_update_function = K.function([], [], updates=[K.update(acting, online) for acting, online
+                                                                  in zip(acting_weights, online_weights)])
+        with self.network_lock:
+            self.sync_acting_network()
+
+    def sync_acting_network(self):
+        # copies the online network into the acting network with assign ops. called with the network lock held, so the
+        # online network isn't in the middle of a train step. a prediction which overlaps the copy may still see the
+        # weights of two consecutive updates, which only affects a single action
+        if self.acting_network is not self.online_network:
+            with self.profiler.phase("acting_sync"):
+                self.acting_update_function([])
+
+    def build_functions(self):
+        """Build the backend functions of the networks and of the target updates, which are otherwise built lazily on
+        their first call. building them is not thread-safe, so they are built before the agent is used from several
+        threads
+        """
+        with self.network_lock:
+            for network in [self.online_network, self.target_network, self.acting_network]:
+                getattr(network, "model", network)._make_predict_function()
+            if self.trainable:
+                getattr(self.online_network, "model", self.online_network)._make_train_function()
+            self.get_target_update_function(1)
+            self.get_target_update_function(self.tau)
+
+    def prepare_minibatch(self):
+        """Sample a minibatch from the experience replay and stack it into arrays
+
+        :return: the stacked minibatch
+        """
+        # with prefetching this runs in the prefetcher thread, overlapping the other phases
+        with self.profiler.phase("sample_minibatch"):
+            if self.architecture == Architecture.SEQUENCE:
+                return self.stack_sequence_minibatch(self.memory.sample_minibatch(self.batch_size))
+            # single transitions are gathered from the columns of the replay directly into arrays
+            return self.memory.sample_stacked_minibatch(self.batch_size)
+
+    def save_snapshot(self, snapshot, score=None):
+        """Save the weights of the target network together with the capture profile of the environment. only the
+        weights are copied here, the files are written in the background
+
+        :param snapshot: the snapshot file
+        :param score: ranks the snapshot when deciding which snapshots to keep (e.g. the average return)
+        """
+        with self.profiler.phase("save_snapshot"):
+            if self.checkpoint_writer is None:
+                self.checkpoint_writer = CheckpointWriter(self.snapshots_keep_last, self.snapshots_keep_best,
+                                                          asynchronous=self.asynchronous_snapshots)
+            with self.network_lock:
+                self.checkpoint_writer.save(self.target_network, snapshot, score, self.environment_spec.capture_profile)
+
+    def save_training_state(self, directory, run_stats=None):
+        """Save everything needed to resume training - both networks, the optimizer state, the exploration state, the
+        experience replay and the stats of the run loop. the directory is replaced atomically, and the experience
+        replay is locked while it is written
+
+        :param directory: the directory of the training state
+        :param run_stats: a JSON serializable dictionary of the stats of the run loop
+        """
+        def write(temp_directory):
+            with self.network_lock:
+                online_weights, target_weights = get_weights_copy(self.online_network), get_weights_copy(self.target_network)
+                # the optimizer has no weights until the first train step
+                optimizer_weights = K.batch_get_value(getattr(self.online_network.optimizer, "weights", []))
+            write_weights(os.path.join(temp_directory, "online.h5"), online_weights)
+            write_weights(os.path.join(temp_directory, "target.h5"), target_weights)
+            np.savez(os.path.join(temp_directory, "optimizer.npz"), *optimizer_weights)
+            os.makedirs(os.path.join(temp_directory, "replay"))
+            with self.memory_lock:
+                self.memory.save(os.path.join(temp_directory, "replay"))
+            training_state = {
+                "epsilon": float(self.epsilon),
+                "exploration_step": self.exploration_step,
+                "average_minimum": float(self.average_minimum),
+                "curr_step": self.curr_step,
+                "win_count": self.win_count,
+                "replay_memory": type(self.memory).__name__,
+                "capture_profile": self.environment_spec.capture_profile,
+                "run_stats": run_stats or {}
+            }
+            with open(os.path.join(temp_directory, "training_state.json"), "w") as state_file:
+                json.dump(training_state, state_file)
+        with self.profiler.phase("save_training_state"):
+            replace_directory_atomically(directory, write)
+
+    def load_training_state(self, directory):
+        """Restore a training state written by save_training_state
+
+        :param directory: the directory of the training state
+        :return: the stats of the run loop which were saved with it
+        """
+        path = find_directory(directory)
+        if path is None:
+            print("ERROR: no training state found in " + directory)
+            exit()
+        print("resuming from training state " + path)
+        with open(os.path.join(path, "training_state.json")) as state_file:
+            training_state = json.load(state_file)
+        if training_state["replay_memory"] != type(self.memory).__name__:
+            print("ERROR: the training state was saved with a " + training_state["replay_memory"] + " replay memory")
+            exit()
+        if training_state["capture_profile"] != self.environment_spec.capture_profile:
+            print("Warning: the training state was saved with the capture profile " +
+                  str(training_state["capture_profile"]))
+
+        self.online_network.load_weights(os.path.join(path, "online.h5"))
+        self.target_network.load_weights(os.path.join(path, "target.h5"))
+        optimizer_weights = np.load(os.path.join(path, "optimizer.npz"))
+        optimizer_weights = [optimizer_weights["arr_" + str(i)] for i in range(len(optimizer_weights.files))]
+        if len(optimizer_weights) > 0:
+            # the optimizer creates its weights together with the train function
+            model = getattr(self.online_network, "model", self.online_network)
+            model._make_train_function()
+            self.online_network.optimizer.set_weights(optimizer_weights)
+
+        with self.network_lock:
+            self.sync_acting_network()
+
+        self.memory.load(os.path.join(path, "replay"))
+        self.exploration_step = training_state["exploration_step"]
+        self.epsilon = training_state["epsilon"]
+        self.average_minimum = training_state["average_minimum"]
+        self.curr_step = training_state["curr_step"]
+        self.target_step = self.curr_step
+        self.win_count = training_state["win_count"]
+        return training_state["run_stats"]
+
+    def close(self):
+        # wait for the snapshots which are still being written
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self.environment is not None:
+            self.environment.close()
 
     def train(self):
         """Train the online network on a minibatch
 
         :return: the train loss
         """
-        minibatch = self.memory.sample_minibatch(self.batch_size)
-        inputs, targets, samples_weights, action_idxs = self.get_inputs_and_targets(minibatch)
-        if self.memory.prioritized:
-            return self.online_network.train_on_batch(inputs, targets, sample_weight=samples_weights)
-        elif self.architecture == Architecture.SEQUENCE: # episodic
-            return self.online_network.train_on_batch([inputs, action_idxs], targets)
-        else:
-            return self.online_network.train_on_batch(inputs, targets)
+        if self.prefetcher is None:
+            self.prefetcher = MinibatchPrefetcher(self.prepare_minibatch, self.memory_lock, self.prefetch_queue_depth,
+                                                  asynchronous=self.prefetch_minibatches)
+        batch = self.prefetcher.get()
+        # the targets and the update are computed with the same weights
+        with self.network_lock:
+            with self.profiler.phase("targets"):
+                if self.architecture == Architecture.SEQUENCE:
+                    inputs, targets, samples_weights, action_idxs = self.get_sequence_targets(batch)
+                else:
+                    inputs, targets, samples_weights, action_idxs = self.get_targets(batch)
+            with self.profiler.phase("train_on_batch"):
+                if self.memory.prioritized:
+                    loss = self.online_network.train_on_batch(inputs, targets, sample_weight=samples_weights)
+                elif self.architecture == Architecture.SEQUENCE: # episodic
+                    loss = self.online_network.train_on_batch([inputs, action_idxs], targets)
+                else:
+                    loss = self.online_network.train_on_batch(inputs, targets)
+            self.sync_acting_network()
+            if self.acting_network is not self.online_network:
+                # catch up with the target updates of the transitions stored since the last train step
+                curr_step = self.curr_step
+                for step in range(self.target_step + 1, curr_step + 1):
+                    self.update_target_network(step)
+                self.target_step = curr_step
+        return loss
+
+class MinibatchPrefetcher(object):
+    # prepares the next minibatches in a worker thread, so sampling and stacking overlap with the gradient step and the
+    # environment step. at most queue_depth minibatches are prepared in advance
+    def __init__(self, prepare_minibatch, memory_lock, queue_depth=2, asynchronous=True):
+        self.prepare_minibatch = prepare_minibatch
+        self.memory_lock = memory_lock
+        self.asynchronous = asynchronous
+        self.minibatches = queue.Queue(maxsize=queue_depth)
+        self.stop_event = threading.Event()
+        self.error = None # the error which stopped the worker thread, raised by every following get
+        if self.asynchronous:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                with self.memory_lock:
+                    minibatch = self.prepare_minibatch()
+            except Exception as e:
+                # the error is raised again by get in the training thread
+                self.error = e
+                return
+            while not self.stop_event.is_set():
+                try:
+                    self.minibatches.put(minibatch, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self):
+        """Get the next minibatch. prepares it in place when prefetching is disabled
+
+        :return: the stacked minibatch
+        """
+        if not self.asynchronous:
+            with self.memory_lock:
+                return self.prepare_minibatch()
+        # the queue is polled, so a get which is waiting when the worker fails raises the error too
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                return self.minibatches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class AsynchronousLearner(object):
+    # trains an agent in a worker thread, so the entity's environment loop doesn't wait for the updates of its agents.
+    # each request allows one more update. a learner which is max_pending updates behind skips the extra requests
+    # instead of slowing down the loop
+    def __init__(self, agent, max_pending=4):
+        self.agent = agent
+        self.max_pending = max_pending
+        self.pending = 0
+        self.updates, self.skipped_updates = 0, 0
+        self.error = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self):
+        """Request an update of the agent. errors of previous updates are raised here"""
+        with self.condition:
+            if self.error is not None:
+                raise self.error
+            if self.pending < self.max_pending:
+                self.pending += 1
+                self.condition.notify()
+            else:
+                self.skipped_updates += 1
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending == 0 and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                self.pending -= 1
+            try:
+                self.agent.train()
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                return
+            with self.condition:
+                self.updates += 1
+
+    def stop(self):
+        """Stop after the current update, dropping the pending ones"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
 
 class Transition(object):
     def __init__(self, preprocessed_curr, action, reward, preprocessed_next):
@@ -750,31 +1582,116 @@ class Transition(object):
         self.reward = reward
         self.preprocessed_next = preprocessed_next
 
-class MemoryRecord(object):
-    def __init__(self, transition_list=[], game_over=False, transition_powered_priority=1):
-        self.transition_list = transition_list
-        self.transition_powered_priority = transition_powered_priority
-        self.game_over = game_over
-        self.is_closed = False
-
-    def add_transition(self, transition, game_over, transition_powered_priority=1):
-        # add a single transition to a record and update the game over state
-        if self.is_closed:
-            raise Exception('record finalized')
-        self.transition_list += [transition]
-        self.transition_powered_priority = transition_powered_priority
-        self.game_over = game_over
-
-    def finalize(self):
-        # finalize the record so no more transitions will be added
-        self.is_closed = True
+    def copy(self):
+        # copy the states, e.g. out of the agent's frame stack
+        preprocessed_next = np.array(self.preprocessed_next) if len(self.preprocessed_next) > 0 else []
+        return Transition(np.array(self.preprocessed_curr), self.action, self.reward, preprocessed_next)
+
+class SumTree(object):
+    # a binary segment tree over a fixed number of leaves. every node holds the sum and the max of the leaves below it,
+    # so proportional sampling, max tracking and priority updates are all O(log N)
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tree_size = 1
+        while self.tree_size < capacity:
+            self.tree_size *= 2
+        self.sums = np.zeros(2 * self.tree_size)
+        self.maxs = np.zeros(2 * self.tree_size)
+        # shifting a node by these gives the nodes of its path to the root
+        self.path_shifts = np.arange(self.tree_size.bit_length())
+
+    def total(self):
+        return self.sums[1]
+
+    def max(self):
+        return self.maxs[1]
+
+    def get(self, leaves):
+        return self.sums[np.asarray(leaves) + self.tree_size]
+
+    def update(self, leaves, values):
+        """Set the values of a batch of leaves and propagate the change to the root
+
+        :param leaves: the leaf indices
+        :param values: the new values
+        """
+        nodes = np.asarray(leaves, dtype=np.int64).reshape(-1) + self.tree_size
+        if len(nodes) == 0:
+            return
+        if len(nodes) <= 16:
+            # inserts update one or two leaves. updating them one path at a time is much cheaper than going through
+            # the levels of the tree, which deduplicates the nodes of each level
+            values = np.asarray(values, dtype=np.float64).reshape(-1)
+            for i in range(len(nodes)):
+                self.update_path(nodes[i], values[i] if len(values) > 1 else values[0])
+            return
+        self.sums[nodes] = values
+        self.maxs[nodes] = values
+        # all the leaves are at the same depth so each level can be updated at once
+        nodes = np.unique(nodes // 2)
+        while True:
+            self.sums[nodes] = self.sums[2 * nodes] + self.sums[2 * nodes + 1]
+            self.maxs[nodes] = np.maximum(self.maxs[2 * nodes], self.maxs[2 * nodes + 1])
+            if nodes[0] == 1:
+                break
+            nodes = np.unique(nodes // 2)
+
+    def update_path(self, node, value):
+        # the sums and the maxs along the path of a leaf are the running sums and maxs of its value and of the siblings
+        # of the path, added in the same order as level by level. the path is updated with a few array operations
+        # instead of a loop over its levels
+        path = node >> self.path_shifts
+        siblings = path[:-1] ^ 1
+        path_values = np.empty(len(path))
+        path_values[0] = value
+        path_values[1:] = self.sums[siblings]
+        self.sums[path] = np.cumsum(path_values)
+        path_values[1:] = self.maxs[siblings]
+        self.maxs[path] = np.maximum.accumulate(path_values)
+
+    def find(self, values):
+        """Find the leaves in which a batch of prefix sums fall
+
+        :param values: prefix sums in the range [0, total)
+        :return: the leaf indices
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self.tree_size:
+            left = 2 * nodes
+            # never descend into an empty subtree because of accumulated rounding errors
+            go_right = (values >= self.sums[left]) & (self.sums[left + 1] > 0)
+            values = np.where(go_right, values - self.sums[left], values)
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - self.tree_size
+
+    def sample(self, batch_size):
+        """Sample leaves proportionally to their values, using one uniform sample in each of batch_size equal segments
+
+        :param batch_size: the number of leaves to sample
+        :return: the sampled leaf indices
+        """
+        values = (np.arange(batch_size) + np.random.rand(batch_size)) * self.total() / float(batch_size)
+        return self.find(values)
+
 
 class ExperienceReplay(object):
-    # memory consists of tuples [transition, game_over, priority^alpha]
-    def __init__(self, max_memory=50000, prioritized=False, store_episodes=False):
+    # memory consists of preallocated circular columns. a record is a single transition, or a sequence of transitions of
+    # an episode when storing episodes, and the transitions of a record are contiguous. records are identified by the
+    # number of records added before them, so the oldest record has the id num_removed and the record with the id
+    # record_id lives in the record slot record_id % (max_memory + 1). transitions live in the transition slot of their
+    # (absolute) index modulo the capacity of the transition columns. records and transitions are both added and
+    # deleted oldest first
+    def __init__(self, max_memory=50000, prioritized=False, store_episodes=False, max_bytes=None):
+        """
+        :param max_memory: the maximal number of records
+        :param max_bytes: the maximal number of bytes of the stored transitions - their states and their rows in the
+                          transition columns. the oldest records are deleted until the memory is under the budget, but
+                          the newest record is always kept, even if it is over the budget by itself
+        """
         # experience replay structure params
         self.max_memory = max_memory
-        self.memory = []
+        self.max_bytes = max_bytes
         self.store_episodes = store_episodes
 
         # prioritized experience replay params
@@ -783,50 +1700,173 @@ class ExperienceReplay(object):
         self.beta_start = 0.4
         self.beta_end = 1
         self.beta = self.beta_end
-        self.sum_powered_priorities = 0 # sum p^alpha
 
-    def is_last_record_closed(self):
-        return self.memory == [] or self.memory[-1].is_closed == True
-
-    def add_record(self, transition, game_over, transition_powered_priority):
-        record = MemoryRecord([transition], game_over, transition_powered_priority)
-        self.memory.append(record)
-
-    def get_last_record(self):
-        return self.memory[-1]
-
-    def close_last_record(self):
-        self.get_last_record().finalize()
-
-    def remember(self, transition, game_over):
+        # record columns. the priorities of the records are kept in a sum tree indexed by record slot
+        record_capacity = max_memory + 1
+        self.record_starts = np.zeros(record_capacity, dtype=np.int64) # the index of the first transition
+        self.record_lengths = np.zeros(record_capacity, dtype=np.int64)
+        self.record_game_overs = np.zeros(record_capacity, dtype=np.bool_)
+        self.record_bytes = np.zeros(record_capacity, dtype=np.int64)
+        self.priorities = SumTree(record_capacity)
+        self.num_records = 0
+        self.num_removed = 0
+        self.last_record_closed = True
+
+        # transition columns. the states are arrays of different records, so they are kept in object columns. the
+        # columns grow when episodes are stored, since the length of the episodes is not known in advance
+        self.transition_capacity = record_capacity
+        self.allocate_transition_columns(self.transition_capacity)
+        self.first_transition = 0 # the index of the oldest stored transition
+        self.num_transitions_added = 0
+        self.episode_id = 0
+        self.transition_row_bytes = sum([column.itemsize for column in [self.actions, self.rewards, self.game_overs,
+                                                                         self.episode_ids, self.curr_states, self.next_states]])
+        self.num_bytes = 0
+
+    def allocate_transition_columns(self, capacity):
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.game_overs = np.zeros(capacity, dtype=np.bool_) # the next state of the transition is a terminal state
+        self.episode_ids = np.zeros(capacity, dtype=np.int64)
+        self.curr_states = np.empty(capacity, dtype=object)
+        self.next_states = np.empty(capacity, dtype=object)
+
+    def __len__(self):
+        return self.num_records
+
+    def get_num_transitions(self):
+        return self.num_transitions_added - self.first_transition
+
+    def get_gauges(self):
+        """Get the current size of the memory
+
+        :return: a dictionary with the number of bytes, records and transitions stored
+        """
+        return {"replay_bytes": int(self.num_bytes), "replay_records": self.num_records,
+                "replay_transitions": self.get_num_transitions()}
+
+    def get_slots(self, indices):
+        return (self.num_removed + np.asarray(indices)) % self.priorities.capacity
+
+    def get_transition_slots(self, transition_idxs):
+        return np.asarray(transition_idxs) % self.transition_capacity
+
+    def grow_transition_columns(self):
+        # move the stored transitions to the slots of their indices in columns of twice the capacity
+        transition_idxs = np.arange(self.first_transition, self.num_transitions_added)
+        old_slots = self.get_transition_slots(transition_idxs)
+        columns = [self.actions, self.rewards, self.game_overs, self.episode_ids, self.curr_states, self.next_states]
+        self.transition_capacity *= 2
+        self.allocate_transition_columns(self.transition_capacity)
+        new_slots = self.get_transition_slots(transition_idxs)
+        for new_column, column in zip([self.actions, self.rewards, self.game_overs, self.episode_ids, self.curr_states,
+                                       self.next_states], columns):
+            new_column[new_slots] = column[old_slots]
+
+    def remember(self, transition, game_over, truncated=False):
         """Add a transition to the experience replay
 
         :param transition: the transition to insert
         :param game_over: is the next state a terminal state?
+        :param truncated: was the episode cut off after this transition? the transition holds its next state, so it is
+                          stored the same way
         """
         # set the priority to the maximum current priority
         transition_powered_priority = 1e-7 ** self.alpha
         if self.prioritized:
-            transition_powered_priority = np.max(self.memory,1)[0,2]
-        self.sum_powered_priorities += transition_powered_priority
+            transition_powered_priority = self.priorities.max() if self.num_records > 0 else 1.0
+
+        # start a new record after the last one was closed. the slots are computed on python ints, inserting is
+        # dominated by the overhead of the numpy calls
+        if self.last_record_closed:
+            record_slot = (self.num_removed + self.num_records) % self.priorities.capacity
+            self.record_starts[record_slot] = self.num_transitions_added
+            self.record_lengths[record_slot] = 0
+            self.record_bytes[record_slot] = 0
+            self.num_records += 1
+            self.last_record_closed = False
+        record_slot = (self.num_removed + self.num_records - 1) % self.priorities.capacity
+
+        # store transition. the states may be views into the agent's frame stack, so they are copied
+        if self.num_transitions_added - self.first_transition == self.transition_capacity:
+            self.grow_transition_columns()
+        slot = self.num_transitions_added % self.transition_capacity
+        self.actions[slot] = transition.action
+        self.rewards[slot] = transition.reward
+        self.game_overs[slot] = game_over
+        self.episode_ids[slot] = self.episode_id
+        self.curr_states[slot] = np.array(transition.preprocessed_curr)
+        self.next_states[slot] = np.array(transition.preprocessed_next) if len(transition.preprocessed_next) > 0 else None
+        self.num_transitions_added += 1
+        transition_bytes = self.transition_row_bytes + self.curr_states[slot].nbytes
+        if self.next_states[slot] is not None:
+            transition_bytes += self.next_states[slot].nbytes
+        self.num_bytes += transition_bytes
+        self.record_bytes[record_slot] += transition_bytes
+        self.record_lengths[record_slot] += 1
+        self.record_game_overs[record_slot] = game_over
+        if self.prioritized:
+            self.priorities.update([record_slot], transition_powered_priority)
+        if game_over:
+            self.episode_id += 1
 
-        # store transition
-        if self.is_last_record_closed():
-            self.add_record(transition, game_over, transition_powered_priority)
-        else:
-            self.get_last_record().add_transition(transition, game_over, transition_powered_priority)
         # finalize the record if necessary
         if not self.store_episodes or (self.store_episodes and (game_over or transition.reward > 0)): #TODO: this is wrong
-            self.close_last_record()
+            self.last_record_closed = True
 
-        # free some space (delete the oldest transition or episode)
-        if len(self.memory) > self.max_memory:
-            if self.prioritized:
-                if self.store_episodes:
-                    self.sum_powered_priorities -= np.sum(np.array(self.memory)[0,:,2])
-                else:
-                    self.sum_powered_priorities -= self.memory[0].transition_powered_priority
-            del self.memory[0]
+        # free some space (delete the oldest transitions or episodes)
+        while self.num_records > self.max_memory or self.is_over_budget():
+            self.remove_oldest_record()
+
+    def is_over_budget(self):
+        # the newest record is never deleted, it may still be written to
+        return self.max_bytes is not None and self.num_bytes > self.max_bytes and self.num_records > 1
+
+    def remove_oldest_record(self):
+        # only the indices of the oldest record and transition are advanced, so the cost doesn't depend on the size of
+        # the memory
+        record_slot = self.num_removed % self.priorities.capacity
+        if self.prioritized:
+            self.priorities.update([record_slot], 0)
+        self.num_bytes -= self.record_bytes[record_slot]
+        # release the states of the transitions of the record
+        record_length = int(self.record_lengths[record_slot])
+        for transition_idx in range(self.first_transition, self.first_transition + record_length):
+            self.curr_states[transition_idx % self.transition_capacity] = None
+            self.next_states[transition_idx % self.transition_capacity] = None
+        self.first_transition += record_length
+        self.num_records -= 1
+        self.num_removed += 1
+
+    def sample_indices(self, batch_size, not_terminals=False):
+        """Sample the indices of a minibatch of records, relative to the oldest record
+
+        :param batch_size: the minibatch size
+        :param not_terminals: sample or don't sample records which end in a terminal state
+        :return: the indices and the sample weights
+        """
+        if self.prioritized: # TODO: not currently working for episodic experience replay
+            # prioritized experience replay - proportional sampling from the sum tree
+            slots = self.priorities.sample(batch_size)
+            indices = (slots - self.num_removed) % self.priorities.capacity
+        else:
+            indices = np.random.randint(self.num_records, size=batch_size)
+
+        if not_terminals:
+            for i in range(batch_size):
+                while self.record_game_overs[self.get_slots(indices[i])]:
+                    indices[i] = np.random.randint(self.num_records)
+
+        weights = np.zeros(batch_size)
+        if self.prioritized: # TODO: not working for episodic experience replay
+            weights = self.get_transition_weights(indices)
+            weights /= np.max(weights) # normalize weights relative to the minibatch
+        return indices, weights
+
+    def get_transitions(self, transition_idxs):
+        return [Transition(self.curr_states[slot], int(self.actions[slot]), float(self.rewards[slot]),
+                           self.next_states[slot] if self.next_states[slot] is not None else [])
+                for slot in self.get_transition_slots(transition_idxs)]
 
     def sample_minibatch(self, batch_size, not_terminals=False):
         """Samples one minibatch of transitions from the experience replay
@@ -835,60 +1875,56 @@ class ExperienceReplay(object):
         :param not_terminals: sample or don't sample transitions were the next state is a terminal state
         :return: a list of tuples of the form: [idx, transition, game_over, weight]
         """
-        batch_size = min(len(self.memory), batch_size)
-        if self.prioritized: # TODO: not currently working for episodic experience replay
-            # prioritized experience replay
-            probs = np.random.rand(batch_size)
-            importances = [self.get_transition_importance(idx) for idx in range(len(self.memory))]
-            thresholds = np.cumsum(importances)
-
-            # multinomial sampling according to priorities
-            indices = []
-            for p in probs:
-                for idx, threshold in zip(range(len(thresholds)), thresholds):
-                    if p < threshold:
-                        indices += [idx]
-                        break
-        else:
-            indices = np.random.choice(len(self.memory), batch_size)
-
-        # TODO: this is just a simple test
-        #positives = [idx for idx, transition in enumerate(self.memory) if self.memory[idx].transition_list[-1].reward > 0]
-        #print(positives)
-        #print(np.random.choice(positives, batch_size/2))
-        #print(indices)
-        #indices = np.append(indices, np.random.choice(positives, batch_size/2))
-        #print(indices)
+        batch_size = min(self.num_records, batch_size)
+        indices, weights = self.sample_indices(batch_size, not_terminals)
 
+        # the minibatch holds the ids of the records rather than their current indices, so priorities can still be
+        # updated after older records were deleted
         minibatch = list()
-        for idx in indices:
-            while not_terminals and self.memory[idx].game_over:
-                idx = np.random.choice(len(self.memory), 1)[0]
-            weight = 0
-            if self.prioritized: # TODO: not working for episodic experience replay
-                weight = self.get_transition_weight(idx)
-            minibatch.append([idx, self.memory[idx].transition_list, self.memory[idx].game_over, weight])  # idx, [transition, transition, ...] , game_over, weight
+        for idx, weight in zip(indices, weights):
+            record_slot = self.get_slots(idx)
+            start = self.record_starts[record_slot]
+            transition_list = self.get_transitions(np.arange(start, start + self.record_lengths[record_slot]))
+            minibatch.append([self.num_removed + idx, transition_list, bool(self.record_game_overs[record_slot]), weight])  # id, [transition, transition, ...] , game_over, weight
+        return minibatch
 
-        if self.prioritized:
-            max_weight = np.max(minibatch,0)[3]
-            for idx in range(len(minibatch)):
-                minibatch[idx][3] /= float(max_weight) # normalize weights relative to the minibatch
+    def sample_stacked_minibatch(self, batch_size):
+        """Samples one minibatch of single transitions and stacks it into arrays. only the states are gathered one by
+        one, all the other columns are gathered at once
 
-        #print([record[0] for record in minibatch])
-        #print([idx for idx, transition in enumerate(self.memory) if self.memory[idx].transition_list[-1].reward > 0])
-        #print(minibatch)
-        return minibatch
+        :param batch_size: the minibatch size
+        :return: the ids, current states, actions, rewards, next states, game over flags and sample weights, as
+                 returned by Agent.stack_minibatch
+        """
+        batch_size = min(self.num_records, batch_size)
+        indices, weights = self.sample_indices(batch_size)
+        slots = self.get_transition_slots(self.record_starts[self.get_slots(indices)])
+        game_overs = self.game_overs[slots]
+        curr_states = np.concatenate(self.curr_states[slots])
+        # terminal transitions have no next state, so their current state is used as a placeholder which is masked later
+        next_states = np.concatenate(np.where(game_overs, self.curr_states[slots], self.next_states[slots]))
+        return (list(self.num_removed + indices), curr_states, self.actions[slots], self.rewards[slots], next_states,
+                game_overs, weights.astype(np.float32))
+
+    def update_transition_priorities(self, transition_ids, priorities):
+        """Update the priorities of a batch of transitions by their ids. transitions which were already deleted are
+        ignored
+
+        :param transition_ids: the ids of the transitions, as returned in the minibatch
+        :param priorities: the new priorities
+        """
+        transition_idxs = np.asarray(transition_ids, dtype=np.int64).reshape(-1) - self.num_removed
+        powered_priorities = (np.asarray(priorities, dtype=np.float64).reshape(-1) + np.spacing(0)) ** self.alpha
+        stored = transition_idxs >= 0
+        self.priorities.update(self.get_slots(transition_idxs[stored]), powered_priorities[stored])
 
     def update_transition_priority(self, transition_idx, priority):
-        """Update the priority of a transition by its index
+        """Update the priority of a transition by its id
 
-        :param transition_idx: the index of the transition
+        :param transition_idx: the id of the transition
         :param priority: the new priority
         """
-        self.sum_powered_priorities -= self.memory[transition_idx].transition_powered_priority
-        powered_priority = (priority+np.spacing(0)) ** self.alpha
-        self.sum_powered_priorities += powered_priority
-        self.memory[transition_idx].transition_powered_priority = powered_priority
+        self.update_transition_priorities([transition_idx], [priority])
 
     def get_transition_importance(self, transition_idx):
         """Get the importance of a transition by its index
@@ -896,24 +1932,468 @@ class ExperienceReplay(object):
         :param transition_idx: the index of the transition
         :return: the importance - priority^alpha/sum(priority^alpha)
         """
-        powered_priority = self.memory[transition_idx].transition_powered_priority
-        importance = powered_priority / float(self.sum_powered_priorities)
+        powered_priority = self.priorities.get(self.get_slots(transition_idx))
+        importance = powered_priority / float(self.priorities.total())
         return importance
 
+    def get_transition_weights(self, transition_idxs):
+        """Get the weights of a batch of transitions by their indices
+
+        :param transition_idxs: the indices of the transitions
+        :return: the weights of the transitions - 1/(importance*N)^beta
+        """
+        weights = 1/(self.get_transition_importance(transition_idxs)*self.max_memory)**self.beta
+        return weights
+
     def get_transition_weight(self, transition_idx):
         """Get the weight of a transition by its index
 
         :param transition_idx: the index of the transition
         :return: the weight of the transition - 1/(importance*N)^beta
         """
-        weight = 1/float(self.get_transition_importance(transition_idx)*self.max_memory)**self.beta
-        return weight
+        return float(self.get_transition_weights(transition_idx))
+
+    def save(self, directory):
+        """Save the contents of the experience replay as .npy columns, which can be memory mapped when loading. the
+        records and their transitions are stored oldest first
+
+        :param directory: an existing directory to write the columns to
+        """
+        record_slots = self.get_slots(np.arange(self.num_records))
+        transition_slots = self.get_transition_slots(np.arange(self.first_transition, self.num_transitions_added))
+        np.save(os.path.join(directory, "record_lengths.npy"), self.record_lengths[record_slots])
+        np.save(os.path.join(directory, "record_game_overs.npy"), self.record_game_overs[record_slots])
+        np.save(os.path.join(directory, "record_powered_priorities.npy"), self.priorities.get(record_slots))
+        for name in ["actions", "rewards", "game_overs", "episode_ids"]:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name)[transition_slots])
+        np.save(os.path.join(directory, "has_next.npy"),
+                np.array([state is not None for state in self.next_states[transition_slots]], dtype=np.bool_))
+        if len(transition_slots) > 0:
+            # the states are written row by row into the files, without stacking them in memory first
+            state = self.curr_states[transition_slots[0]][0]
+            for name in ["curr_states", "next_states"]:
+                states = np.lib.format.open_memmap(os.path.join(directory, name + ".npy"), mode="w+",
+                                                   dtype=state.dtype, shape=(len(transition_slots),) + state.shape)
+                for idx, slot in enumerate(transition_slots):
+                    preprocessed = getattr(self, name)[slot]
+                    if preprocessed is not None:
+                        states[idx] = preprocessed[0]
+                states.flush()
+                del states
+        with open(os.path.join(directory, "replay.json"), "w") as replay_file:
+            json.dump({"store_episodes": self.store_episodes, "num_removed": self.num_removed,
+                       "last_record_closed": self.last_record_closed, "episode_id": self.episode_id}, replay_file)
+
+    def load(self, directory):
+        """Replace the contents of the experience replay with the columns written by save. if the memory is smaller
+        than the saved one, or the saved one is over the byte budget, only the newest records are kept
+
+        :param directory: the directory of the columns
+        """
+        with open(os.path.join(directory, "replay.json")) as replay_file:
+            replay_state = json.load(replay_file)
+        if replay_state["store_episodes"] != self.store_episodes:
+            print("ERROR: the saved experience replay does not match the architecture of the agent")
+            exit()
+        def load_column(name):
+            return np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+        record_lengths = np.array(load_column("record_lengths"))
+        self.__init__(self.max_memory, self.prioritized, self.store_episodes, self.max_bytes)
+
+        # the bytes of each saved record, as they would be accounted for by remember
+        has_next = np.array(load_column("has_next"))
+        state_bytes = 0
+        if len(has_next) > 0:
+            state_bytes = load_column("curr_states")[0:1].nbytes
+        transition_bytes = self.transition_row_bytes + state_bytes * (1 + has_next.astype(np.int64))
+        record_bytes = np.zeros(len(record_lengths), dtype=np.int64)
+        if len(record_lengths) > 0:
+            record_bytes = np.add.reduceat(transition_bytes, np.cumsum(record_lengths) - record_lengths)
+
+        num_dropped = max(len(record_lengths) - self.max_memory, 0)
+        if self.max_bytes is not None:
+            # keep the newest records which fit in the budget, and at least the newest record
+            newest_bytes = np.cumsum(record_bytes[::-1])
+            num_kept = max(int(np.sum(newest_bytes <= self.max_bytes)), 1)
+            num_dropped = max(num_dropped, len(record_lengths) - num_kept)
+        first = int(np.sum(record_lengths[:num_dropped]))
+        num_transitions = int(np.sum(record_lengths)) - first
+        while self.transition_capacity < num_transitions + 1:
+            self.transition_capacity *= 2
+        self.allocate_transition_columns(self.transition_capacity)
+        transition_slots = np.arange(num_transitions)
+        for name in ["actions", "rewards", "game_overs", "episode_ids"]:
+            getattr(self, name)[transition_slots] = load_column(name)[first:]
+        if num_transitions > 0:
+            # read the states into memory at once, the stored states are views into them
+            has_next = has_next[first:]
+            curr_states, next_states = np.array(load_column("curr_states")[first:]), np.array(load_column("next_states")[first:])
+            for slot in transition_slots:
+                self.curr_states[slot] = curr_states[slot:slot+1]
+                self.next_states[slot] = next_states[slot:slot+1] if has_next[slot] else None
+        self.num_transitions_added = num_transitions
+
+        record_lengths = record_lengths[num_dropped:]
+        self.num_records = len(record_lengths)
+        self.num_removed = replay_state["num_removed"] + num_dropped
+        record_slots = self.get_slots(np.arange(self.num_records))
+        self.record_lengths[record_slots] = record_lengths
+        self.record_starts[record_slots] = np.cumsum(record_lengths) - record_lengths
+        self.record_game_overs[record_slots] = load_column("record_game_overs")[num_dropped:]
+        self.record_bytes[record_slots] = record_bytes[num_dropped:]
+        self.num_bytes = int(np.sum(record_bytes[num_dropped:]))
+        if self.prioritized:
+            self.priorities.update(record_slots, load_column("record_powered_priorities")[num_dropped:])
+        self.last_record_closed = replay_state["last_record_closed"]
+        self.episode_id = replay_state["episode_id"]
+
+
+class FrameStore(object):
+    # the frames of the visited states in preallocated circular columns indexed by slot. each slot holds only the newest
+    # frame of the current state of a step. the store can be shared by the frame replays of several agents which see
+    # the same frames (e.g. the agents of an entity), so each frame is stored once and the replays keep only their own
+    # actions, rewards and priorities in the same slots
+    def __init__(self, max_memory=50000, frame_shape=(image_height, image_width), frame_dtype=np.uint8):
+        self.max_memory = max_memory
+        self.frames = np.zeros((max_memory,) + tuple(frame_shape), dtype=frame_dtype)
+        self.game_overs = np.zeros(max_memory, dtype=np.bool_)
+        # the slot holds the next frame of the last step of an episode which was cut off, it is not a transition
+        self.truncations = np.zeros(max_memory, dtype=np.bool_)
+        self.episode_starts = np.zeros(max_memory, dtype=np.int64) # the (absolute) step in which each slot's episode started
+        self.num_stored = 0 # total number of frames ever stored
+        self.episode_start = 0
+        # held by all the agents which share the store while they store or sample transitions
+        self.lock = threading.Lock()
+        # the replays over the store. a frame overwrites a slot of all of them at once, not only of the replay storing it
+        self.replays = []
+
+    def append(self, frame, game_over, truncated=False):
+        """Store the frame of the next step
+
+        :param frame: the newest frame of the current state
+        :param game_over: is the next state a terminal state?
+        :param truncated: is the frame the next frame of the last step of an episode which was cut off?
+        """
+        # a new episode starts after a terminal state or after the last frame of a cut off episode
+        previous_slot = (self.num_stored - 1) % self.max_memory
+        if self.num_stored == 0 or self.game_overs[previous_slot] or self.truncations[previous_slot]:
+            self.episode_start = self.num_stored
+
+        # overwrites the oldest slot once the store is full
+        slot = self.num_stored % self.max_memory
+        if self.num_stored >= self.max_memory:
+            for replay in self.replays:
+                replay.invalidate_slot(slot)
+        self.frames[slot] = frame
+        self.game_overs[slot] = game_over
+        self.truncations[slot] = truncated
+        self.episode_starts[slot] = self.episode_start
+        self.num_stored += 1
+
+    def get_states(self, steps, history_length):
+        """Rebuild the stacked states of the given steps from the stored frames. frames which precede the start of the
+        episode are replaced by the first frame of the episode, the same way the agent initializes its state
+
+        :param steps: an array of (absolute) steps
+        :param history_length: the number of frames in a state
+        :return: the stacked states, shaped (len(steps), history_length, height, width)
+        """
+        window = steps[:, None] + np.arange(1 - history_length, 1)[None, :]
+        window = np.maximum(window, self.episode_starts[steps % self.max_memory][:, None])
+        return self.frames[window % self.max_memory]
+
+    def save(self, directory):
+        """Save the columns of the store as .npy files, which can be memory mapped when loading
+
+        :param directory: an existing directory to write the columns to
+        """
+        for name in ["frames", "game_overs", "truncations", "episode_starts"]:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+        with open(os.path.join(directory, "frame_store.json"), "w") as store_file:
+            json.dump({"num_stored": self.num_stored, "episode_start": self.episode_start}, store_file)
+
+    def load(self, directory):
+        """Replace the contents of the store with the columns written by save. the slots are indexed by step, so the
+        saved store must have the same size
+
+        :param directory: the directory of the columns
+        """
+        frames = np.load(os.path.join(directory, "frames.npy"), mmap_mode="r")
+        if frames.shape != self.frames.shape:
+            print("ERROR: the saved experience replay holds " + str(frames.shape) + " frames instead of " +
+                  str(self.frames.shape))
+            exit()
+        # copy into the preallocated columns
+        for name in ["frames", "game_overs", "truncations", "episode_starts"]:
+            getattr(self, name)[:] = np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+        with open(os.path.join(directory, "frame_store.json")) as store_file:
+            store_state = json.load(store_file)
+        self.num_stored = store_state["num_stored"]
+        self.episode_start = store_state["episode_start"]
+
+
+class FrameReplay(object):
+    # memory consists of preallocated circular columns indexed by slot, next to the frames of a frame store. the stacked
+    # states are rebuilt from index windows into the store instead of storing each frame history_length*2 times.
+    # the replays which share a store must all store a transition on every step
+    def __init__(self, max_memory=50000, history_length=4, frame_shape=(image_height, image_width), frame_dtype=np.uint8,
+                 prioritized=False, frame_store=None):
+        """
+        :param frame_store: a frame store shared with other replays. the replay has the size of the store
+        """
+        # experience replay structure params
+        self.store = frame_store if frame_store is not None else FrameStore(max_memory, frame_shape, frame_dtype)
+        self.max_memory = self.store.max_memory
+        self.history_length = history_length
+        self.actions = np.zeros(self.max_memory, dtype=np.int32)
+        self.rewards = np.zeros(self.max_memory, dtype=np.float32)
+        self.num_stored = 0 # total number of transitions ever stored
+        self.store_episodes = False
+
+        # prioritized experience replay params. slots which can't be sampled yet (or anymore) have a zero priority
+        self.prioritized = prioritized
+        self.alpha = 0.6 # prioritization factor
+        self.beta_start = 0.4
+        self.beta_end = 1
+        self.beta = self.beta_end
+        self.priorities = SumTree(self.max_memory)
+        self.store.replays.append(self)
+
+    def __len__(self):
+        return min(self.num_stored, self.max_memory)
+
+    def get_gauges(self):
+        """Get the current size of the memory. the columns are preallocated, so the bytes don't change. the bytes of a
+        shared frame store are counted by each of its replays
+
+        :return: a dictionary with the number of bytes, records and transitions stored
+        """
+        num_bytes = sum([column.nbytes for column in [self.store.frames, self.store.game_overs, self.store.truncations,
+                                                      self.store.episode_starts, self.actions, self.rewards,
+                                                      self.priorities.sums, self.priorities.maxs]])
+        return {"replay_bytes": int(num_bytes), "replay_records": len(self), "replay_transitions": len(self)}
+
+    def remember(self, transition, game_over, truncated=False):
+        """Add a transition to the experience replay. only the newest frame of the current state is stored, the next
+        state is recovered from the slot of the following transition
+
+        :param transition: the transition to insert
+        :param game_over: is the next state a terminal state?
+        :param truncated: was the episode cut off after this transition? its next state isn't the current state of a
+                          following transition, so the newest frame of the next state is stored in a slot of its own
+        """
+        # the first of the replays sharing the store to reach a step stores its frame
+        if self.num_stored == self.store.num_stored:
+            self.store.append(transition.preprocessed_curr[0][-1], game_over)
+            if truncated:
+                self.store.append(transition.preprocessed_next[0][-1], False, truncated=True)
+
+        # store transition (overwrites the oldest slot once the memory is full)
+        step = self.num_stored
+        slot = step % self.max_memory
+        self.actions[slot] = transition.action
+        self.rewards[slot] = transition.reward
+        self.num_stored += 1
+        if truncated:
+            # the slot of the last frame holds no transition
+            self.actions[self.num_stored % self.max_memory] = 0
+            self.rewards[self.num_stored % self.max_memory] = 0
+            self.num_stored += 1
+
+        if self.prioritized:
+            # set the priority to the maximum current priority once the transition can be sampled
+            powered_priority = self.priorities.max() if self.priorities.max() > 0 else 1.0
+            first, last = self.get_sampling_range()
+            # the slot of the new step was cleared by the store, it can't be sampled before its next state is stored.
+            # the previous step becomes sampleable now unless it was terminal, in which case it was sampleable already
+            # and may have a learned priority, or unless it holds the last frame of a cut off episode. a terminal or
+            # truncated new step is sampleable at once
+            previous = step - 1
+            pending = []
+            if (previous >= first and not self.store.game_overs[previous % self.max_memory] and
+                    not self.store.truncations[previous % self.max_memory]):
+                pending.append(previous)
+            if last == step:
+                pending.append(last)
+            self.priorities.update(np.array(pending, dtype=np.int64) % self.max_memory, powered_priority)
+
+    def invalidate_slot(self, slot):
+        """Stop sampling the transitions whose states include the frame of a slot, called by the store before the frame
+        is overwritten
+
+        :param slot: the slot of the store which is overwritten
+        """
+        # the older transitions which include the frame left the sampling range before, so only the transition whose
+        # state starts with the frame leaves it now. the first time the store wraps, the range starts at step 0 and
+        # all of them leave it at once
+        if self.prioritized:
+            first_slot = slot if self.store.num_stored == self.max_memory else slot + self.history_length - 1
+            self.priorities.update(np.arange(first_slot, slot + self.history_length) % self.max_memory, 0)
+
+    def get_sampling_range(self):
+        """Get the range of (absolute) steps that can be sampled. the newest transition can't be sampled until its next
+        state is stored and the oldest transitions can't be sampled after their history was overwritten
+
+        :return: the first and last steps that can be sampled
+        """
+        # another replay of the store may have stored the frame of the next step already
+        first = 0
+        if self.store.num_stored > self.max_memory:
+            first = self.store.num_stored - self.max_memory + self.history_length - 1
+        last = self.num_stored - 1
+        if last >= 0 and not self.store.game_overs[last % self.max_memory]:
+            last -= 1
+        return first, last
+
+    def sample_steps(self, batch_size, not_terminals=False):
+        """Sample the (absolute) steps of a minibatch of transitions
+
+        :param batch_size: the minibatch size
+        :param not_terminals: sample or don't sample transitions were the next state is a terminal state
+        :return: the steps and the sample weights
+        """
+        first, last = self.get_sampling_range()
+        batch_size = min(last - first + 1, batch_size)
+        if self.prioritized:
+            # proportional sampling from the sum tree. slots are converted back to absolute steps
+            slots = self.priorities.sample(batch_size)
+            steps = self.num_stored - 1 - (self.num_stored - 1 - slots) % self.max_memory
+            # rounding errors of the sum tree may still reach slots with a zero priority
+            steps = np.clip(steps, first, last)
+        else:
+            steps = np.random.randint(first, last + 1, batch_size)
+            # the slots of the last frames of cut off episodes hold no transitions. the last step is never one of them
+            truncated = self.store.truncations[steps % self.max_memory]
+            while np.any(truncated):
+                steps[truncated] = np.random.randint(first, last + 1, np.count_nonzero(truncated))
+                truncated = self.store.truncations[steps % self.max_memory]
+        if not_terminals:
+            for i in range(batch_size):
+                while self.store.game_overs[steps[i] % self.max_memory]:
+                    steps[i] = np.random.randint(first, last + 1)
+
+        weights = np.zeros(batch_size)
+        if self.prioritized:
+            weights = self.get_transition_weights(steps % self.max_memory)
+            weights /= np.max(weights) # normalize weights relative to the minibatch
+        return steps, weights
+
+    def sample_minibatch(self, batch_size, not_terminals=False):
+        """Samples one minibatch of transitions from the experience replay
+
+        :param batch_size: the minibatch size
+        :param not_terminals: sample or don't sample transitions were the next state is a terminal state
+        :return: a list of tuples of the form: [idx, transition, game_over, weight]
+        """
+        steps, weights = self.sample_steps(batch_size, not_terminals)
+        slots = steps % self.max_memory
+        curr_states = self.store.get_states(steps, self.history_length)
+        next_states = self.store.get_states(steps + 1, self.history_length)
+
+        minibatch = list()
+        for i, slot in enumerate(slots):
+            game_over = bool(self.store.game_overs[slot])
+            preprocessed_next = [] if game_over else next_states[i:i+1]
+            transition = Transition(curr_states[i:i+1], int(self.actions[slot]), float(self.rewards[slot]), preprocessed_next)
+            minibatch.append([steps[i], [transition], game_over, weights[i]])  # step, [transition], game_over, weight
+
+        return minibatch
+
+    def sample_stacked_minibatch(self, batch_size):
+        """Samples one minibatch of transitions and gathers it from the columns directly into arrays
+
+        :param batch_size: the minibatch size
+        :return: the steps, current states, actions, rewards, next states, game over flags and sample weights, as
+                 returned by Agent.stack_minibatch
+        """
+        steps, weights = self.sample_steps(batch_size)
+        slots = steps % self.max_memory
+        game_overs = self.store.game_overs[slots]
+        curr_states = self.store.get_states(steps, self.history_length)
+        # terminal transitions have no next state, so their current state is used as a placeholder which is masked later
+        next_states = self.store.get_states(np.where(game_overs, steps, steps + 1), self.history_length)
+        return (list(steps), curr_states, self.actions[slots].astype(np.int64), self.rewards[slots], next_states,
+                game_overs, weights.astype(np.float32))
+
+    def update_transition_priorities(self, transition_idxs, priorities):
+        """Update the priorities of a batch of transitions by their (absolute) steps. transitions which can't be
+        sampled anymore are ignored
+
+        :param transition_idxs: the steps of the transitions, as returned in the minibatch
+        :param priorities: the new priorities
+        """
+        steps = np.asarray(transition_idxs, dtype=np.int64).reshape(-1)
+        powered_priorities = (np.asarray(priorities, dtype=np.float64).reshape(-1) + np.spacing(0)) ** self.alpha
+        stored = steps >= self.get_sampling_range()[0]
+        self.priorities.update(steps[stored] % self.max_memory, powered_priorities[stored])
+
+    def update_transition_priority(self, transition_idx, priority):
+        self.update_transition_priorities([transition_idx], [priority])
+
+    def get_transition_weights(self, transition_idxs):
+        """Get the weights of a batch of transitions by their slots
+
+        :param transition_idxs: the slots of the transitions
+        :return: the weights of the transitions - 1/(importance*N)^beta
+        """
+        importances = self.priorities.get(transition_idxs) / float(self.priorities.total())
+        return 1/(importances*self.max_memory)**self.beta
+
+    def save(self, directory):
+        """Save the columns of the experience replay and of its frame store as .npy files, which can be memory mapped
+        when loading
+
+        :param directory: an existing directory to write the columns to
+        """
+        self.store.save(directory)
+        for name in ["actions", "rewards"]:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+        np.save(os.path.join(directory, "powered_priorities.npy"), self.priorities.get(np.arange(self.max_memory)))
+        with open(os.path.join(directory, "replay.json"), "w") as replay_file:
+            json.dump({"num_stored": self.num_stored}, replay_file)
+
+    def load(self, directory):
+        """Replace the contents of the experience replay and of its frame store with the columns written by save
+
+        :param directory: the directory of the columns
+        """
+        self.store.load(directory)
+        for name in ["actions", "rewards"]:
+            getattr(self, name)[:] = np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+        self.priorities = SumTree(self.max_memory)
+        self.priorities.update(np.arange(self.max_memory), np.load(os.path.join(directory, "powered_priorities.npy")))
+        with open(os.path.join(directory, "replay.json")) as replay_file:
+            replay_state = json.load(replay_file)
+        self.num_stored = replay_state["num_stored"]
 
 
 class Entity(object):
     def __init__(self, agents_args_list, entity_args):
+        # the phases of all the agents are measured together with the entity's
+        self.profiler = Profiler(enabled=entity_args.get("profile", False), sink=entity_args.get("profile_file"))
+        self.metrics = create_metrics_logger(entity_args)
+        # a single environment is stepped by the entity and shared by the agents, which don't create their own
+        self.environment = create_environment(entity_args.get("environment_backend", EnvironmentBackend.VIZDOOM),
+                                              level=entity_args["level"], combine_actions=entity_args["combine_actions"],
+                                              capture_mode=entity_args.get("capture_mode", CaptureMode.CONFIG),
+                                              environment_args=entity_args.get("environment_args"))
+        # the agents see the same frames, so their frame replays can share a single copy of them. the shared replays
+        # all have the size of the largest one
+        self.frame_store = None
+        if entity_args.get("shared_frame_store", False):
+            for args in agents_args_list:
+                if (args.get("replay_memory", ReplayMemory.TRANSITIONS) != ReplayMemory.FRAMES or
+                        args.get("max_action_sequence_length", 1) > 1):
+                    print("ERROR: a shared frame store requires all the agents to use the frames replay memory with "
+                          "single transitions")
+                    exit()
+            self.frame_store = FrameStore(max([args["max_memory"] for args in agents_args_list]),
+                                          (image_height, image_width))
         self.agents = []
         for args in agents_args_list:
+            # each agent chooses from the buttons of the level it was trained on
+            actions = ActionSpace(read_level_config(args["level"])["availablebuttons"], args["combine_actions"],
+                                  args.get("exclusive_buttons"))
             agent = Agent(algorithm=args["algorithm"],
                           discount=args["discount"],
                           snapshot=args["snapshot"],
@@ -932,7 +2412,14 @@ class Entity(object):
                           target_update_freq=args["target_update_freq"],
                           epsilon_start=args["epsilon_start"],
                           epsilon_end=args["epsilon_end"],
-                          epsilon_annealing_steps=args["epsilon_annealing_steps"])
+                          epsilon_annealing_steps=args["epsilon_annealing_steps"],
+                          profiler=self.profiler,
+                          snapshots_keep_last=args.get("snapshots_keep_last"),
+                          snapshots_keep_best=args.get("snapshots_keep_best"),
+                          environment_spec=get_environment_spec(self.environment, actions),
+                          replay_memory=args.get("replay_memory", ReplayMemory.TRANSITIONS),
+                          frame_store=self.frame_store,
+                          max_memory_bytes=args.get("max_memory_bytes"))
 
             if (args["mode"] == Mode.TEST or args["mode"] == Mode.DISPLAY) and args["snapshot"] == '':
                 print("Warning: mode set to " + str(args["mode"]) + " but no snapshot was loaded")
@@ -943,12 +2430,25 @@ class Entity(object):
         self.mode = entity_args["mode"]
         self.start_learning_after = entity_args["start_learning_after"]
         self.average_over_num_episodes = entity_args["average_over_num_episodes"]
+        self.max_returned_episodes = entity_args.get("max_returned_episodes", 10000)
         self.snapshot_episodes = entity_args["snapshot_episodes"]
-        self.environment = Environment(level=entity_args["level"], combine_actions=entity_args["combine_actions"])
         self.history_length = entity_args["history_length"]
         self.win_count = 0
         self.curr_step = 0
 
+        # the agents predict on the shared frame concurrently and each one trains in its own thread
+        self.parallel_agents = entity_args.get("parallel_agents", True)
+        self.executor, self.learners = None, []
+        if self.parallel_agents:
+            for agent in self.agents:
+                if self.mode == Mode.TRAIN:
+                    agent.create_acting_network()
+                agent.build_functions()
+            self.executor = ThreadPoolExecutor(max_workers=len(self.agents))
+            if self.mode == Mode.TRAIN:
+                self.learners = [AsynchronousLearner(agent, entity_args.get("max_pending_updates", 4))
+                                 for agent in self.agents]
+
     def combine_actions(self, aiming_actions, exploring_actions):
         # aiming_actions (defend_the_center) = 1. TURN_LEFT, 2. TURN_RIGHT, 3. ATTACK
         # exploring_actions (health_gathering or my_way_home) = 1. TURN_LEFT, 2. TURN_RIGHT, 3. MOVE_FORWARD, 4. MOVE_LEFT, 5. MOVE_RIGHT
@@ -969,16 +2469,16 @@ class Entity(object):
         return actions
 
     def step(self, action):
-        # repeat action several times and stack the states
+        # repeat action several times and return the last frame
         reward = 0
         game_over = False
-        next_state = list()
+        next_frame = None
         for t in range(self.history_length):
-            s, r, game_over = self.environment.step(action)
+            with self.profiler.phase("environment_step"):
+                next_frame, r, game_over = self.environment.step(action)
             reward += r # reward is accumulated
             if game_over:
                 break
-            next_state.append(s)
 
         # episode finished
         if game_over:
@@ -987,30 +2487,37 @@ class Entity(object):
         if reward > 0 and game_over:
             self.win_count += 1
 
-        return next_state, reward, game_over
+        return next_frame, reward, game_over
 
     def run(self):
         # initialize
         total_steps, average_return = 0, 0
-        returns = []
+        returns = deque(maxlen=self.max_returned_episodes)
         for i in range(self.episodes):
             self.environment.new_episode()
+            for agent in self.agents:
+                agent.start_episode(self.environment.get_curr_state())
             steps, curr_return = 0, 0
             game_over = False
             while not game_over and steps < self.steps_per_episode:
                 # each agent predicts the action it should do
+                if self.parallel_agents:
+                    predictions = list(self.executor.map(lambda agent: agent.predict(), self.agents))
+                else:
+                    predictions = [agent.predict() for agent in self.agents]
                 actions, action_idxs = [], []
-                for agent in self.agents:
-                    action, action_idx, _ = agent.predict()
-                    actions += [action]
-                    action_idxs += [action_idx]
+                for agent_actions, agent_action_idxs, _ in predictions:
+                    actions += [agent_actions[0]]
+                    action_idxs += [int(agent_action_idxs[0])]
                 # the actions are combined together
                 action = self.combine_actions(actions[0], actions[1]) #TODO: make this more generic
                 # the entity performs the action
-                next_state, reward, game_over = self.step(action)
-                # each agent preprocesses the next state and stores it
+                next_frame, reward, game_over = self.step(action)
+                # each agent preprocesses the next frame and stores the transition. the replays end the episode
+                # where the agents start the next one, also when it is cut off
+                truncated = not game_over and steps + 1 >= self.steps_per_episode
                 for agent_idx, agent in enumerate(self.agents):
-                    agent.store_next_state(next_state, reward, game_over, action_idxs[agent_idx])
+                    agent.store_frame(next_frame, reward, game_over, action_idxs[agent_idx], truncated)
 
                 steps += 1
                 curr_return += reward
@@ -1020,14 +2527,23 @@ class Entity(object):
                     sleep(0.05)
 
                 if i > self.start_learning_after and self.mode == Mode.TRAIN:
-                    for agent in self.agents:
-                        agent.train()
+                    if self.parallel_agents:
+                        for learner in self.learners:
+                            learner.request()
+                    else:
+                        for agent in self.agents:
+                            agent.train()
 
             # average results
             n = float(self.average_over_num_episodes)
             average_return = (1 - 1 / n) * average_return + (1 / n) * curr_return
             total_steps += steps
-            returns += [average_return]
+            returns.append(average_return)
+            self.metrics.log("episodes", {"episode": i, "steps": steps, "total_steps": total_steps,
+                                          "return": float(curr_return), "average_return": float(average_return),
+                                          "updates": [learner.updates for learner in self.learners],
+                                          "skipped_updates": [learner.skipped_updates for learner in self.learners],
+                                          "replays": [agent.memory.get_gauges() for agent in self.agents]})
 
             # print progress
             print("")
@@ -1040,17 +2556,165 @@ class Entity(object):
                 for agent_idx, agent in enumerate(self.agents):
                     snapshot = 'agent' + str(agent_idx) + '_model_' + str(i + 1) + '.h5'
                     print(str(datetime.datetime.now()) + " >> saving snapshot to " + snapshot)
-                    agent.target_network.save_weights(snapshot, overwrite=True)
+                    agent.save_snapshot(snapshot, average_return)
 
-        self.environment.game.close()
-        return returns
+            profile = self.profiler.end_episode(i)
+            if self.profiler.enabled:
+                print("profile: " + format_profile(profile))
 
+        self.metrics.close()
+        for learner in self.learners:
+            learner.stop()
+        if self.executor is not None:
+            self.executor.shutdown()
+        for agent in self.agents:
+            agent.close()
+        self.environment.close()
+        return list(returns)
 
-def run_experiment(args):
-    """ Run a single experiment, either train, test or display of an agent
+
+def create_metrics_logger(args):
+    """Create the metrics logger of an experiment. nothing is logged if no metrics directory is given
 
     :param args: a dictionary containing all the parameters for the run
-    :return: lists of average returns and mean Q values
+    :return: the metrics logger
+    """
+    return MetricsLogger(args.get("metrics_directory"), args.get("metrics_format", MetricsFormat.JSONL),
+                         args.get("metrics_file_records", 100000))
+
+
+def to_float(value):
+    # losses are numpy scalars, or lists of them for models with several outputs
+    if value is None:
+        return None
+    return float(np.mean(value))
+
+
+def print_throughput(total_steps, total_updates, start_time):
+    elapsed = max(time.time() - start_time, 1e-6)
+    print("env_steps/sec = " + str(total_steps / elapsed) + " updates/sec = " + str(total_updates / elapsed))
+
+
+def print_replay_gauges(memory):
+    gauges = memory.get_gauges()
+    print("replay = " + str(gauges["replay_records"]) + " records " + str(gauges["replay_transitions"]) +
+          " transitions " + str(round(gauges["replay_bytes"] / 2.0 ** 20, 1)) + " MB")
+
+
+def resume_training(agent, args):
+    """Restore the training state to resume from, if one is given
+
+    :param args: a dictionary containing all the parameters for the run
+    :return: the stats of the run loop which were saved with the training state, or an empty dictionary
+    """
+    if not args.get("resume_from"):
+        return {}
+    return agent.load_training_state(args["resume_from"])
+
+
+class RunProgress(object):
+    # the counters and the averaged stats of an experiment loop, which are saved with its training states. the
+    # synchronous, vectorized and asynchronous loops all report their finished episodes through end_episode
+    def __init__(self, args, run_stats):
+        """
+        :param args: a dictionary containing all the parameters for the run
+        :param run_stats: the stats of the run loop restored with a training state, or an empty dictionary
+        """
+        n = int(args["average_over_num_episodes"])
+        self.episode = run_stats.get("episode", -1) + 1 # the index of the next episode
+        self.total_steps = run_stats.get("total_steps", 0)
+        self.total_updates = run_stats.get("total_updates", 0)
+        self.start_time = time.time() - run_stats.get("time", 0)
+        self.return_buffer = deque(run_stats.get("return_buffer", []), maxlen=n + 1)
+        self.mean_q_buffer = deque(run_stats.get("mean_q_buffer", []), maxlen=n + 1)
+        self.returns_over_all_episodes = deque(run_stats.get("returns_over_all_episodes", []),
+                                               maxlen=args.get("max_returned_episodes", 10000))
+        self.mean_q_over_all_episodes = deque(run_stats.get("mean_q_over_all_episodes", []),
+                                              maxlen=args.get("max_returned_episodes", 10000))
+
+    def get_results(self):
+        return list(self.returns_over_all_episodes), list(self.mean_q_over_all_episodes)
+
+    def end_episode(self, agent, args, metrics, curr_return, mean_q, loss, epsilon, steps=None, source=None):
+        """Store the stats of a finished episode, log and print them, and save the snapshot and the training state if
+        they are due
+
+        :param curr_return: the return of the episode
+        :param mean_q: the mean Q value of the episode
+        :param loss: the loss to report with the episode
+        :param epsilon: the epsilon the episode was played with
+        :param steps: the number of steps of the episode, if it is known
+        :param source: the name and the index of the environment or the actor which played the episode, if there are
+                       several
+        """
+        episode = self.episode
+        self.return_buffer.append(curr_return)
+        average_return = np.mean(self.return_buffer)
+
+        self.mean_q_buffer.append(mean_q)
+        average_mean_q = np.mean(self.mean_q_buffer)
+
+        self.returns_over_all_episodes.append(average_return)
+        self.mean_q_over_all_episodes.append(average_mean_q)
+        record = {"episode": episode}
+        if source is not None:
+            record[source[0]] = int(source[1])
+        if steps is not None:
+            record["steps"] = int(steps)
+        record.update({"total_steps": self.total_steps, "total_updates": self.total_updates,
+                       "time": time.time() - self.start_time, "epsilon": float(epsilon), "loss": to_float(loss),
+                       "return": float(curr_return), "average_return": float(average_return),
+                       "mean_q": float(mean_q), "average_mean_q": float(average_mean_q)})
+        record.update(agent.memory.get_gauges())
+        metrics.log("episodes", record)
+
+        print("")
+        print(str(datetime.datetime.now()))
+        source_label = "" if source is None else " " + source[0] + " = " + str(source[1])
+        print("episode = " + str(episode) + source_label + " steps = " + str(self.total_steps))
+        print("epsilon = " + str(epsilon) + " loss = " + str(loss))
+        print("current_return = " + str(curr_return) + " average return = " + str(average_return))
+        print_throughput(self.total_steps, self.total_updates, self.start_time)
+        print_replay_gauges(agent.memory)
+
+        # save snapshot of target network
+        if episode % args["snapshot_episodes"] == args["snapshot_episodes"] - 1:
+            snapshot = 'model_' + str(episode + 1) + '.h5'
+            print(str(datetime.datetime.now()) + " >> saving snapshot to " + snapshot)
+            agent.save_snapshot(snapshot, average_return)
+        self.save_training_state(agent, args)
+
+        profile = agent.profiler.end_episode(episode)
+        if agent.profiler.enabled:
+            print("profile: " + format_profile(profile))
+
+        self.episode += 1
+
+    def save_training_state(self, agent, args):
+        # save a resumable training state every training_state_episodes episodes, together with the stats of the run
+        interval = args.get("training_state_episodes")
+        if not interval or self.episode % interval != interval - 1:
+            return
+        directory = args.get("training_state_directory", "training_state")
+        print(str(datetime.datetime.now()) + " >> saving training state to " + directory)
+        agent.save_training_state(directory, {
+            "episode": self.episode,
+            "total_steps": int(self.total_steps),
+            "total_updates": int(self.total_updates),
+            "time": time.time() - self.start_time,
+            "return_buffer": [float(value) for value in self.return_buffer],
+            "mean_q_buffer": [float(value) for value in self.mean_q_buffer],
+            "returns_over_all_episodes": [float(value) for value in self.returns_over_all_episodes],
+            "mean_q_over_all_episodes": [float(value) for value in self.mean_q_over_all_episodes]
+        })
+
+
+def create_agent(args, environment_spec=None):
+    """ Create an agent according to the parameters of an experiment
+
+    :param args: a dictionary containing all the parameters for the run
+    :param environment_spec: the spec of the environments the agent acts in, if it doesn't create its own
+    :return: the agent
     """
     agent = Agent(algorithm=args["algorithm"],
                   discount=args["discount"],
@@ -1072,20 +2736,45 @@ def run_experiment(args):
                   epsilon_annealing_steps=args["epsilon_annealing_steps"],
                   architecture=args["architecture"],
                   visible=False,
-                  max_action_sequence_length=args["max_action_sequence_length"])
+                  max_action_sequence_length=args["max_action_sequence_length"],
+                  replay_memory=args.get("replay_memory", ReplayMemory.TRANSITIONS),
+                  prefetch_minibatches=args.get("prefetch_minibatches", True),
+                  frame_resampling=args.get("frame_resampling", Resampling.BILINEAR),
+                  capture_mode=args.get("capture_mode", CaptureMode.CONFIG),
+                  environment_backend=args.get("environment_backend", EnvironmentBackend.VIZDOOM),
+                  environment_args=args.get("environment_args"),
+                  profiler=Profiler(enabled=args.get("profile", False), sink=args.get("profile_file")),
+                  snapshots_keep_last=args.get("snapshots_keep_last"),
+                  snapshots_keep_best=args.get("snapshots_keep_best"),
+                  asynchronous_snapshots=args.get("asynchronous_snapshots", True),
+                  incremental_target_update=args.get("incremental_target_update", False),
+                  exclusive_buttons=args.get("exclusive_buttons"),
+                  max_memory_bytes=args.get("max_memory_bytes"),
+                  environment_spec=environment_spec)
 
     if (args["mode"] == Mode.TEST or args["mode"] == Mode.DISPLAY) and args["snapshot"] == '':
         print("Warning: mode set to " + str(args["mode"]) + " but no snapshot was loaded")
 
-    n = float(args["average_over_num_episodes"])
+    return agent
 
-    # initialize
-    total_steps = 0
-    returns_over_all_episodes = []
-    mean_q_over_all_episodes = []
-    return_buffer = []
-    mean_q_buffer = []
-    for i in range(args["episodes"]):
+
+def run_experiment(args):
+    """ Run a single experiment, either train, test or display of an agent
+
+    :param args: a dictionary containing all the parameters for the run
+    :return: lists of average returns and mean Q values
+    """
+    if args.get("num_actors", 0) > 0:
+        return run_async_experiment(args)
+    if args.get("num_environments", 1) > 1:
+        return run_vectorized_experiment(args)
+
+    agent = create_agent(args)
+    progress = RunProgress(args, resume_training(agent, args))
+    metrics = create_metrics_logger(args)
+
+    while progress.episode < args["episodes"]:
+        i = progress.episode
         agent.environment.new_episode()
         steps, curr_return, curr_Qs, loss = 0, 0, 0, 0
         game_over = False
@@ -1097,7 +2786,7 @@ def run_experiment(args):
                 next_state, reward, game_over = agent.step(action, action_idx)
                 agent.store_next_state(next_state, reward, game_over, action_idx)
                 steps += 1
-                total_steps += 1
+                progress.total_steps += 1
                 curr_return += reward
                 curr_Qs += mean_Q
 
@@ -1105,40 +2794,291 @@ def run_experiment(args):
                 if args["mode"] == Mode.DISPLAY:
                     sleep(0.05)
 
-                if i > args["start_learning_after"] and args["mode"] == Mode.TRAIN and total_steps % args["steps_between_train"] == 0:
-                    loss += agent.train()
+                step_loss = None
+                if i > args["start_learning_after"] and args["mode"] == Mode.TRAIN and progress.total_steps % args["steps_between_train"] == 0:
+                    step_loss = agent.train()
+                    loss += step_loss
+                    progress.total_updates += 1
                     #print("finished training")
+                if args.get("log_step_metrics", False):
+                    metrics.log("steps", {"step": progress.total_steps, "episode": i, "action": action_idx, "reward": float(reward),
+                                          "mean_q": float(mean_Q), "loss": to_float(step_loss)})
                 if game_over or steps > args["steps_per_episode"]:
                     break
 
-        # store stats
-        if len(return_buffer) > n:
-            del return_buffer[0]
-        return_buffer += [curr_return]
-        average_return = np.mean(return_buffer)
+        progress.end_episode(agent, args, metrics, curr_return, curr_Qs / float(steps), loss, agent.epsilon, steps)
 
-        if len(mean_q_buffer) > n:
-            del mean_q_buffer[0]
-        mean_q_buffer += [curr_Qs / float(steps)]
-        average_mean_q = np.mean(mean_q_buffer)
+    metrics.close()
+    agent.close()
+    return progress.get_results()
 
-        returns_over_all_episodes += [average_return]
-        mean_q_over_all_episodes += [average_mean_q]
 
-        print("")
-        print(str(datetime.datetime.now()))
-        print("episode = " + str(i) + " steps = " + str(total_steps))
-        print("epsilon = " + str(agent.epsilon) + " loss = " + str(loss))
-        print("current_return = " + str(curr_return) + " average return = " + str(average_return))
+def run_vectorized_experiment(args):
+    """ Run a single experiment where the agent acts in several environments at once. each step performs a single
+    forward pass for all the environments, which are stepped in parallel worker processes
 
-        # save snapshot of target network
-        if i % args["snapshot_episodes"] == args["snapshot_episodes"] - 1:
-            snapshot = 'model_' + str(i + 1) + '.h5'
-            print(str(datetime.datetime.now()) + " >> saving snapshot to " + snapshot)
-            agent.target_network.save_weights(snapshot, overwrite=True)
+    :param args: a dictionary containing all the parameters for the run
+    :return: lists of average returns and mean Q values
+    """
+    if (args["architecture"] == Architecture.SEQUENCE or
+            args.get("replay_memory", ReplayMemory.TRANSITIONS) == ReplayMemory.FRAMES):
+        print("ERROR: vectorized environments support only single actions and the transitions replay memory")
+        exit()
+
+    # the agent acts only in the environments of the workers, so it doesn't create one of its own
+    num_environments = args["num_environments"]
+    capture_mode = get_snapshot_capture_mode(args["snapshot"], args.get("capture_mode", CaptureMode.CONFIG))
+    environments = VectorEnvironment(num_environments, level=args["level"], combine_actions=args["combine_actions"],
+                                     skipped_frames=args["skipped_frames"],
+                                     resampling=args.get("frame_resampling", Resampling.BILINEAR),
+                                     capture_mode=capture_mode,
+                                     environment_backend=args.get("environment_backend", EnvironmentBackend.VIZDOOM),
+                                     environment_args=args.get("environment_args"),
+                                     exclusive_buttons=args.get("exclusive_buttons"))
+    agent = create_agent(args, get_environment_spec(environments))
+    progress = RunProgress(args, resume_training(agent, args))
+    metrics = create_metrics_logger(args)
+
+    # initialize
+    steps = np.zeros(num_environments, dtype=np.int64)
+    curr_returns = np.zeros(num_environments)
+    curr_Qs = np.zeros(num_environments)
+    # the loss is averaged over the updates since the last finished episode of any environment
+    interval_loss, interval_updates = 0, 0
+    frames = environments.reset()
+    preprocessed_currs = np.repeat(frames[:, None], agent.history_length, axis=1)
+    while progress.episode < args["episodes"]:
+        actions, action_idxs, max_Qs = agent.predict_batch(preprocessed_currs)
+        with agent.profiler.phase("environment_step"):
+            frames, rewards, game_overs = environments.step(action_idxs)
+        preprocessed_nexts = np.concatenate([preprocessed_currs[:, 1:], frames[:, None]], axis=1)
+        agent.store_next_states(preprocessed_currs, preprocessed_nexts, rewards, game_overs, action_idxs)
+
+        steps += 1
+        curr_returns += rewards
+        curr_Qs += max_Qs
+        if args.get("log_step_metrics", False):
+            for idx in range(num_environments):
+                metrics.log("steps", {"step": progress.total_steps + idx + 1, "environment": idx, "action": int(action_idxs[idx]),
+                                      "reward": float(rewards[idx]), "max_q": float(max_Qs[idx])})
+
+        # train as many times as a single environment would have in the same number of steps
+        if progress.episode > args["start_learning_after"] and args["mode"] == Mode.TRAIN:
+            for step in range(progress.total_steps + 1, progress.total_steps + num_environments + 1):
+                if step % args["steps_between_train"] == 0:
+                    interval_loss += agent.train()
+                    interval_updates += 1
+                    progress.total_updates += 1
+        progress.total_steps += num_environments
+
+        # environments which reached the steps limit start a new episode as well
+        finished = game_overs | (steps >= args["steps_per_episode"])
+        truncated = np.nonzero(finished & ~game_overs)[0]
+        if len(truncated) > 0:
+            with agent.profiler.phase("environment_step"):
+                frames[truncated] = environments.reset(truncated)
+        preprocessed_currs = np.where(finished[:, None, None, None],
+                                      np.repeat(frames[:, None], agent.history_length, axis=1), preprocessed_nexts)
+
+        loss = interval_loss / float(interval_updates) if interval_updates > 0 else 0
+        if np.any(finished):
+            interval_loss, interval_updates = 0, 0
+        for idx in np.nonzero(finished)[0]:
+            progress.end_episode(agent, args, metrics, curr_returns[idx], curr_Qs[idx] / float(steps[idx]), loss,
+                                 agent.epsilon, steps[idx], ("environment", idx))
+            steps[idx], curr_returns[idx], curr_Qs[idx] = 0, 0, 0
+
+    metrics.close()
+    environments.close()
+    agent.close()
+    return progress.get_results()
+
+
+def put_until_stopped(messages_queue, message, stop_event):
+    # a bounded queue blocks the producer, but it should still notice when the experiment is stopped
+    while not stop_event.is_set():
+        try:
+            messages_queue.put(message, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def pull_weights(agent, weights_queue, weights_version, local_version, max_weights_staleness, stop_event):
+    """Load the latest weights published by the learner into the online network of an actor. if the local weights
+    are more than max_weights_staleness updates behind, wait until new weights arrive
+
+    :return: the version of the actor's weights
+    """
+    block = weights_version.value - local_version > max_weights_staleness
+    while not stop_event.is_set():
+        try:
+            version, weights = weights_queue.get(block=block, timeout=1)
+        except queue.Empty:
+            if not block:
+                return local_version
+            continue
+        agent.online_network.set_weights(weights)
+        return version
+    return local_version
+
+
+def publish_weights(agent, weights_queues, weights_version, version, stop_event):
+    weights = agent.online_network.get_weights()
+    for weights_queue in weights_queues:
+        # replace the weights the actor didn't pick up yet. the queue may be full while its feeder thread didn't flush
+        # the weights yet, so they are taken out with a timeout rather than with get_nowait
+        while not stop_event.is_set():
+            try:
+                weights_queue.put_nowait((version, weights))
+                break
+            except queue.Full:
+                pass
+            try:
+                weights_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+    weights_version.value = version
+
+
+def actor_worker(actor_idx, args, transitions_queue, weights_queue, weights_version, stop_event):
+    """Act in a separate environment with a local copy of the online network and send the transitions and the episode
+    results to the learner
+
+    :param actor_idx: the index of the actor
+    :param args: a dictionary containing all the parameters for the run
+    """
+    np.random.seed() # the random state is shared by all the forked processes
+    actor_args = dict(args, max_memory=1, prioritized_experience=False, profile=False)
+    if args.get("environment_backend") == EnvironmentBackend.SYNTHETIC:
+        # each synthetic environment generates different frames and rewards
+        actor_args["environment_args"] = dict(args.get("environment_args") or {})
+        actor_args["environment_args"]["seed"] = actor_args["environment_args"].get("seed", 0) + actor_idx
+    agent = create_agent(actor_args)
+    if actor_idx == 0:
+        # the learner doesn't create an environment of its own, it is created from the spec of the actors' environments
+        put_until_stopped(transitions_queue, ("spec", agent.environment_spec), stop_event)
+    local_version = pull_weights(agent, weights_queue, weights_version, -1, 0, stop_event)
+    actor_steps = 0
+    while not stop_event.is_set():
+        agent.environment.new_episode()
+        steps, curr_return, curr_Qs = 0, 0, 0
+        game_over = False
+        while not game_over and steps < args["steps_per_episode"] and not stop_event.is_set():
+            actions, action_idxs, mean_Q = agent.predict()
+            for action, action_idx in zip(actions, action_idxs):
+                action_idx = int(action_idx)
+                next_state, reward, game_over = agent.step(action, action_idx)
+                # the transition is pickled in the background, after the frame stack has moved on
+                transition = agent.make_transition(next_state, reward, action_idx).copy()
+                put_until_stopped(transitions_queue, ("transition", transition, game_over), stop_event)
+                steps += 1
+                actor_steps += 1
+                curr_return += reward
+                curr_Qs += mean_Q
+
+                # pull the latest weights of the learner once in a while
+                if actor_steps % args["actor_sync_interval"] == 0:
+                    local_version = pull_weights(agent, weights_queue, weights_version, local_version,
+                                                 args["max_weights_staleness"], stop_event)
+                if game_over or steps > args["steps_per_episode"]:
+                    break
+
+        put_until_stopped(transitions_queue, ("episode", actor_idx, curr_return, curr_Qs / float(max(steps, 1)),
+                                              agent.epsilon), stop_event)
 
-    agent.environment.game.close()
-    return returns_over_all_episodes, mean_q_over_all_episodes
+    agent.close()
+
+
+def run_async_experiment(args):
+    """ Run a single experiment where one or more actor processes generate transitions continuously while the learner
+    trains on the experience replay. the learner publishes its weights to the actors every weights_publish_interval
+    updates, and an actor which is more than max_weights_staleness updates behind waits for new weights
+
+    :param args: a dictionary containing all the parameters for the run
+    :return: lists of average returns and mean Q values
+    """
+    num_actors = args["num_actors"]
+    if num_actors > 1 and (args["architecture"] == Architecture.SEQUENCE or
+                           args.get("replay_memory", ReplayMemory.TRANSITIONS) == ReplayMemory.FRAMES):
+        print("ERROR: multiple actors support only single actions and the transitions replay memory")
+        exit()
+
+    # the actors are forked before the learner builds its networks, forking a process with a backend session isn't safe
+    transitions_queue = multiprocessing.Queue(maxsize=args["transitions_queue_size"])
+    weights_queues = [multiprocessing.Queue(maxsize=1) for actor_idx in range(num_actors)]
+    weights_version = multiprocessing.Value('i', 0)
+    stop_event = multiprocessing.Event()
+    actors = []
+    for actor_idx in range(num_actors):
+        actor = multiprocessing.Process(target=actor_worker, args=(actor_idx, args, transitions_queue,
+                                                                   weights_queues[actor_idx], weights_version, stop_event))
+        actor.daemon = True
+        actor.start()
+        actors.append(actor)
+
+    # the learner acts only through the actors, so it is created from the spec of their environments. the actors wait
+    # for the first weights, so the spec is the first message in the queue
+    environment_spec = None
+    while environment_spec is None:
+        try:
+            _, environment_spec = transitions_queue.get(timeout=1)
+        except queue.Empty:
+            if not actors[0].is_alive():
+                print("ERROR: the first actor stopped before sending the spec of its environment")
+                exit()
+    agent = create_agent(args, environment_spec)
+    # restored before the first weights are published to the actors
+    progress = RunProgress(args, resume_training(agent, args))
+    publish_weights(agent, weights_queues, weights_version, 0, stop_event)
+
+    metrics = create_metrics_logger(args)
+
+    # initialize
+    loss = 0
+    while progress.episode < args["episodes"]:
+        learning = progress.episode > args["start_learning_after"] and args["mode"] == Mode.TRAIN
+
+        # consume everything the actors generated since the last update. wait for them only if there is nothing to learn
+        messages = []
+        try:
+            messages.append(transitions_queue.get(block=not learning, timeout=1))
+            while len(messages) < args["transitions_queue_size"]:
+                messages.append(transitions_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        for message in messages:
+            if message[0] == "transition":
+                _, transition, game_over = message
+                agent.remember(transition, game_over)
+                progress.total_steps += 1
+                continue
+
+            # an actor finished an episode - store stats
+            _, actor_idx, curr_return, mean_q, epsilon = message
+            progress.end_episode(agent, args, metrics, curr_return, mean_q, loss, epsilon, source=("actor", actor_idx))
+            loss = 0
+
+        if learning:
+            loss += agent.train()
+            progress.total_updates += 1
+            if progress.total_updates % args["weights_publish_interval"] == 0:
+                publish_weights(agent, weights_queues, weights_version, progress.total_updates, stop_event)
+
+    # stop the actors. the queue is drained so none of them stays blocked on it
+    stop_event.set()
+    for actor in actors:
+        while actor.is_alive():
+            try:
+                transitions_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+            actor.join(timeout=0.1)
+
+    metrics.close()
+    agent.close()
+    return progress.get_results()
 
 
 if __name__ == "__main__":
@@ -1162,7 +3102,8 @@ if __name__ == "__main__":
             "snapshot": 'defend_model_1000.h5',
             "mode": Mode.TRAIN,
             "skipped_frames": 4,
-            "target_update_freq": 3000
+            "target_update_freq": 3000,
+            "replay_memory": ReplayMemory.FRAMES
         }
 
         exploring_agent = {
@@ -1180,7 +3121,8 @@ if __name__ == "__main__":
             "snapshot": 'health_model_500.h5',
             "mode": Mode.TRAIN,
             "skipped_frames": 4,
-            "target_update_freq": 3000
+            "target_update_freq": 3000,
+            "replay_memory": ReplayMemory.FRAMES
         }
 
         entity_args = {
@@ -1192,7 +3134,13 @@ if __name__ == "__main__":
             "mode": Mode.TRAIN,
             "history_length": 4,
             "level": Level.DEATHMATCH,
-            "combine_actions": True
+            "combine_actions": True,
+            "metrics_directory": "metrics/entity",
+            "parallel_agents": True, # predict concurrently and train each agent in its own thread
+            # the frame replays of the agents share a single copy of the frames. requires all the agents to use the
+            # frames replay memory, whose max_memory is then overridden by the largest max_memory of the agents
+            "shared_frame_store": True,
+            "max_pending_updates": 4 # updates a learner can fall behind before it skips them
         }
 
         entity = Entity([aiming_agent, exploring_agent], entity_args)
@@ -1202,6 +3150,7 @@ if __name__ == "__main__":
         plt.xlabel("episode")
         plt.ylabel("average return")
         plt.title("Average Return")
+        plt.savefig("metrics/entity/average_return.png")
 
     elif experiment == "single_agent":
         lstm = {
@@ -1258,7 +3207,26 @@ if __name__ == "__main__":
             "epsilon_end": 0.01,
             "epsilon_annealing_steps": 3e4,
             "architecture": Architecture.DIRECT,
-            "max_action_sequence_length": 1
+            "max_action_sequence_length": 1,
+            "replay_memory": ReplayMemory.FRAMES,
+            "capture_mode": CaptureMode.CONFIG,
+            "profile": False, # print the time spent in each phase of every episode
+            "profile_file": None, # a JSON lines file the profile of every episode is appended to
+            "log_step_metrics": False, # log a record for every step in addition to every episode
+            "snapshots_keep_last": 3, # older snapshots are deleted, unless they are among the best ones
+            "snapshots_keep_best": 3, # by average return
+            "training_state_episodes": None, # save everything needed to resume training every this many episodes
+            "training_state_directory": "training_state",
+            "resume_from": '', # a training state directory to resume training from
+            "incremental_target_update": False, # soft updates of the target network every 10 steps
+            "exclusive_buttons": None, # e.g. OPPOSITE_BUTTONS, to prune the combined actions which press both buttons
+            "max_memory_bytes": None, # e.g. 4e9, bounds the transitions replay memory, whose episodes can be arbitrarily long
+            "num_environments": 1,
+            "num_actors": 0, # > 0 runs the actors in separate processes, asynchronously to the learner
+            "actor_sync_interval": 100,
+            "weights_publish_interval": 100,
+            "max_weights_staleness": 1000,
+            "transitions_queue_size": 1000
         }
 
         lstm = {
@@ -1287,17 +3255,22 @@ if __name__ == "__main__":
             "epsilon_end": 0.01,
             "epsilon_annealing_steps": 3e4,
             "architecture": Architecture.SEQUENCE,
-            "max_action_sequence_length": 5
+            "max_action_sequence_length": 5,
+            "replay_memory": ReplayMemory.TRANSITIONS
         }
 
         runs = [lstm]
 
         colors = ["r", "g", "b"]
-        for color, run in zip(colors, runs):
+        metrics_directory = "metrics/" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        for run_idx, (color, run) in enumerate(zip(colors, runs)):
             # run agent
-            returns, Qs = run_experiment(run)
+            run["metrics_directory"] = metrics_directory + "/run" + str(run_idx)
+            run_experiment(run)
 
-            # plot results
+            # plot results. the whole run is read back from the metrics files
+            returns = read_metric(run["metrics_directory"], "episodes", "average_return")
+            Qs = read_metric(run["metrics_directory"], "episodes", "average_mean_q")
             plt.figure(1)
             plt.plot(range(len(returns)), returns, color)
             plt.xlabel("episode")
@@ -1310,4 +3283,8 @@ if __name__ == "__main__":
             plt.ylabel("mean Q value")
             plt.title("Mean Q Value")
 
-        plt.show()
+        # the figures are saved rather than shown, so the end of the run does not block
+        plt.figure(1)
+        plt.savefig(metrics_directory + "/average_return.png")
+        plt.figure(2)
+        plt.savefig(metrics_directory + "/mean_q.png")
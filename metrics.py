@@ -0,0 +1,153 @@
+import csv
+import glob
+import json
+import os
+import queue
+import threading
+from enum import Enum
+
+
+class MetricsFormat(Enum):
+    JSONL = 1
+    CSV = 2
+
+
+class MetricsLogger(object):
+    # writes records of named streams (e.g. steps, episodes) to rotating files in a directory. the records are queued and
+    # written by a background thread which flushes the files after each batch of records, so the metrics of a run which
+    # crashed are kept. the queue is bounded, so logging blocks rather than growing without limit if the writer falls
+    # behind. a logger without a directory ignores all the records
+    def __init__(self, directory=None, file_format=MetricsFormat.JSONL, max_file_records=100000, queue_size=10000):
+        """
+        :param directory: the directory the files are written to
+        :param file_format: write JSON lines or CSV files
+        :param max_file_records: the number of records in a file before a new file is started
+        :param queue_size: the number of records which can wait for the writer
+        """
+        self.directory = directory
+        self.enabled = directory is not None
+        self.file_format = file_format
+        self.max_file_records = max_file_records
+        self.files = {} # stream -> [file, csv writer, number of records in the file, index of the file]
+        if not self.enabled:
+            return
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.records = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log(self, stream, record):
+        """Queue a record to be written
+
+        :param stream: the name of the stream, which is the prefix of its files
+        :param record: a dictionary of values. all the records of a CSV stream should have the same keys
+        """
+        while self.enabled:
+            try:
+                self.records.put((stream, record), timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def run(self):
+        while True:
+            # write everything which is already queued, then flush once
+            records = [self.records.get()]
+            try:
+                while len(records) < 1000:
+                    records.append(self.records.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                for stream_record in records:
+                    if stream_record is None:
+                        self.close_files()
+                        return
+                    self.write(*stream_record)
+                for stream_file in self.files.values():
+                    stream_file[0].flush()
+            except Exception as e:
+                # stop logging rather than blocking the run once the queue is full
+                print("Warning: metrics are not logged anymore - " + str(e))
+                self.enabled = False
+                self.close_files()
+                return
+
+    def write(self, stream, record):
+        if stream not in self.files or self.files[stream][2] == self.max_file_records:
+            self.open_file(stream, record)
+        stream_file = self.files[stream]
+        if self.file_format == MetricsFormat.CSV:
+            stream_file[1].writerow(record)
+        else:
+            stream_file[0].write(json.dumps(record) + "\n")
+        stream_file[2] += 1
+
+    def open_file(self, stream, record):
+        index = 0
+        if stream in self.files:
+            self.files[stream][0].close()
+            index = self.files[stream][3] + 1
+        extension = ".csv" if self.file_format == MetricsFormat.CSV else ".jsonl"
+        stream_file = open(os.path.join(self.directory, stream + "_" + str(index).zfill(5) + extension), "w")
+        writer = None
+        if self.file_format == MetricsFormat.CSV:
+            # the columns are the keys of the first record in the file
+            writer = csv.DictWriter(stream_file, fieldnames=list(record.keys()), extrasaction="ignore")
+            writer.writeheader()
+        self.files[stream] = [stream_file, writer, 0, index]
+
+    def close_files(self):
+        for stream_file in self.files.values():
+            stream_file[0].close()
+
+    def close(self):
+        """Write all the queued records and close the files"""
+        if self.enabled:
+            self.records.put(None)
+            self.thread.join()
+            self.enabled = False
+
+
+def parse_csv_value(value):
+    if value == "":
+        return None
+    for value_type in [int, float]:
+        try:
+            return value_type(value)
+        except ValueError:
+            pass
+    if value in ["True", "False"]:
+        return value == "True"
+    return value
+
+
+def read_metrics(directory, stream):
+    """Stream the records of a stream from its files, oldest first. the files may be read while they are written
+
+    :param directory: the directory of the metrics
+    :param stream: the name of the stream
+    :return: a generator of the records as dictionaries
+    """
+    for path in sorted(glob.glob(os.path.join(directory, stream + "_*"))):
+        with open(path) as stream_file:
+            if path.endswith(".csv"):
+                for row in csv.DictReader(stream_file):
+                    yield {key: parse_csv_value(value) for key, value in row.items()}
+            else:
+                for line in stream_file:
+                    if line.endswith("\n"): # the last line may still be written
+                        yield json.loads(line)
+
+
+def read_metric(directory, stream, key):
+    """Read the values of a single metric, e.g. for plotting
+
+    :param directory: the directory of the metrics
+    :param stream: the name of the stream
+    :param key: the name of the metric
+    :return: a list of the values of the records which have the metric
+    """
+    return [record[key] for record in read_metrics(directory, stream) if record.get(key) is not None]
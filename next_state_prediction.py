@@ -585,7 +585,7 @@ if __name__ == "__main__":
             agent.store_next_state(next_state, reward, game_over, action_idx[0])
             steps += 1
 
-    agent.environment.game.close()
+    agent.environment.close()
 
 
 
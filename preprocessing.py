@@ -0,0 +1,175 @@
+import numpy as np
+from enum import Enum
+
+
+class Resampling(Enum):
+    BILINEAR = 1 # matches scipy.misc.imresize (PIL bilinear) up to rounding
+    AREA = 2
+
+
+def area_resampling_matrix(input_size, output_size):
+    """Build the matrix which resamples a single axis by area averaging. each output pixel is the average of the input
+    pixels it covers, weighted by the covered fraction of each input pixel
+
+    :param input_size: the size of the input axis
+    :param output_size: the size of the output axis
+    :return: a matrix shaped (output_size, input_size)
+    """
+    scale = input_size / float(output_size)
+    matrix = np.zeros((output_size, input_size), dtype=np.float32)
+    for output_idx in range(output_size):
+        start, end = output_idx * scale, (output_idx + 1) * scale
+        for input_idx in range(int(np.floor(start)), min(int(np.ceil(end)), input_size)):
+            matrix[output_idx, input_idx] = (min(end, input_idx + 1) - max(start, input_idx)) / scale
+    return matrix
+
+
+def bilinear_resampling_matrix(input_size, output_size):
+    """Build the matrix which resamples a single axis the same way PIL's bilinear filter does. when downsampling, the
+    triangle filter is stretched over all the input pixels covered by an output pixel
+
+    :param input_size: the size of the input axis
+    :param output_size: the size of the output axis
+    :return: a matrix shaped (output_size, input_size)
+    """
+    scale = input_size / float(output_size)
+    support = max(scale, 1.0)
+    matrix = np.zeros((output_size, input_size), dtype=np.float32)
+    for output_idx in range(output_size):
+        center = (output_idx + 0.5) * scale
+        first, last = max(int(center - support + 0.5), 0), min(int(center + support + 0.5), input_size)
+        weights = np.maximum(0, 1 - np.abs((np.arange(first, last) - center + 0.5) / support))
+        matrix[output_idx, first:last] = weights / np.sum(weights)
+    return matrix
+
+
+class FramePreprocessor(object):
+    # converts screen buffers to greyscale and resizes them to the network input size. the resampling and greyscale
+    # weights are computed once, and frames are processed in batches into a preallocated output buffer.
+    # frames are either channels first (channels, height, width) or already greyscale (height, width)
+    def __init__(self, screen_height, screen_width, output_height, output_width, greyscale_weights=None,
+                 bytescale=True, dtype=np.uint8, resampling=Resampling.BILINEAR):
+        self.screen_height = screen_height
+        self.screen_width = screen_width
+        self.output_height = output_height
+        self.output_width = output_width
+        self.greyscale_weights = None if greyscale_weights is None else np.asarray(greyscale_weights, dtype=np.float32)
+        # stretch each frame to the full [0, 255] range the same way scipy.misc.imresize did, so the frames match
+        # the ones the existing snapshots were trained on
+        self.bytescale = bytescale
+        self.dtype = dtype
+
+        # the resampling is separable, so it is applied as two matrix products, columns first
+        if resampling == Resampling.AREA:
+            resampling_matrix = area_resampling_matrix
+        else:
+            resampling_matrix = bilinear_resampling_matrix
+        self.rows_matrix = resampling_matrix(screen_height, output_height)
+        self.columns_matrix = resampling_matrix(screen_width, output_width).T
+
+    def __call__(self, frame, out=None):
+        """Preprocess a single frame
+
+        :param frame: a frame shaped (channels, height, width) or (height, width)
+        :param out: an optional preallocated output buffer shaped (output_height, output_width)
+        :return: the preprocessed frame
+        """
+        return self.preprocess_batch(np.asarray(frame)[None], None if out is None else out[None])[0]
+
+    def preprocess_batch(self, frames, out=None):
+        """Preprocess a batch of frames
+
+        :param frames: frames shaped (batch, channels, height, width) or (batch, height, width)
+        :param out: an optional preallocated output buffer shaped (batch, output_height, output_width)
+        :return: the preprocessed frames
+        """
+        batch_size = frames.shape[0]
+        if out is None:
+            out = np.empty((batch_size, self.output_height, self.output_width), dtype=self.dtype)
+
+        # greyscale. the channels are summed in place, and the normalization is applied to the much smaller output
+        if frames.ndim == 3:
+            grey, normalization = frames.astype(np.float32), 1.0
+        elif self.greyscale_weights is None:
+            grey, normalization = frames[:, 0].astype(np.float32), 1.0 / frames.shape[1]
+            for channel in range(1, frames.shape[1]):
+                grey += frames[:, channel]
+        else:
+            grey, normalization = np.multiply(frames[:, 0], self.greyscale_weights[0], dtype=np.float32), 1.0
+            for channel in range(1, frames.shape[1]):
+                grey += np.multiply(frames[:, channel], self.greyscale_weights[channel], dtype=np.float32)
+
+        resized = np.matmul(self.rows_matrix, np.matmul(grey, self.columns_matrix))
+        if self.bytescale:
+            minimums = grey.min(axis=(1, 2))
+            ranges = grey.max(axis=(1, 2)) - minimums
+            ranges[ranges == 0] = 1
+            resized -= minimums[:, None, None]
+            resized *= (255.0 / ranges)[:, None, None]
+        elif normalization != 1.0:
+            resized *= normalization
+
+        if np.issubdtype(out.dtype, np.integer):
+            np.clip(resized, 0, 255, out=resized)
+            resized += 0.5
+        out[...] = resized
+        return out
+
+
+class FrameStack(object):
+    # keeps the last history_length preprocessed frames in a preallocated buffer with some slack after them. pushing a
+    # frame only writes it after the current window, and the windows are returned as views, so nothing is allocated
+    # per step. the current window is copied back to the start of the buffer once the slack is used up.
+    # the views are only valid until the window wraps around, so anyone who keeps them for longer should copy them
+    def __init__(self, history_length, height, width, dtype=np.uint8, slack=256):
+        self.history_length = history_length
+        self.buffer = np.zeros((history_length + max(slack, 1), height, width), dtype=dtype)
+        self.end = history_length # the window is buffer[end - history_length:end]
+        self.empty = True
+
+    def clear(self):
+        self.empty = True
+
+    def next_frame(self):
+        """Get the slot the next pushed frame will be stored in, so the frame can be written into it directly
+
+        :return: a view of the slot shaped (height, width)
+        """
+        if self.end == len(self.buffer):
+            # the whole window is kept so the previous window is still available after the next push
+            self.buffer[:self.history_length] = self.buffer[self.end - self.history_length:self.end]
+            self.end = self.history_length
+        return self.buffer[self.end]
+
+    def push(self, frame):
+        """Add a frame to the stack. the oldest frame is dropped
+
+        :param frame: the frame, or the slot returned by next_frame after it was written
+        """
+        slot = self.next_frame()
+        if not np.may_share_memory(slot, frame):
+            slot[...] = frame
+        self.end += 1
+
+    def reset(self, frame):
+        """Start a new stack with the given frame duplicated history_length times
+
+        :param frame: the first frame
+        """
+        self.end = self.history_length
+        self.buffer[:self.end] = frame
+        self.empty = False
+
+    def current(self):
+        """Get the current window
+
+        :return: a view shaped (1, history_length, height, width)
+        """
+        return self.buffer[None, self.end - self.history_length:self.end]
+
+    def previous(self):
+        """Get the window before the last pushed frame. only valid right after a push
+
+        :return: a view shaped (1, history_length, height, width)
+        """
+        return self.buffer[None, self.end - self.history_length - 1:self.end - 1]
@@ -0,0 +1,84 @@
+import json
+import threading
+import time
+
+
+class Phase(object):
+    # times a single call of a phase. a new one is created for each call, so calls which overlap (e.g. in the minibatch
+    # prefetcher and in the learner) don't share their start time. the totals are accumulated by the profiler
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class DisabledPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Profiler(object):
+    # accumulates the wall time and the number of calls of named phases during an episode. phases may be nested (e.g.
+    # preprocess inside predict), in which case the time of the inner phase is included in both.
+    # a disabled profiler costs a single attribute check per phase. the phases may be timed from several threads, so
+    # the totals are updated under a lock
+    def __init__(self, enabled=True, sink=None):
+        """
+        :param enabled: measure the phases
+        :param sink: a file the summary of each episode is appended to, as a line of JSON
+        """
+        self.enabled = enabled
+        self.sink = sink
+        self.disabled_phase = DisabledPhase()
+        self.seconds = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def phase(self, name):
+        """Time a phase, to be used as a context manager
+
+        :param name: the name of the phase
+        :return: the context manager
+        """
+        if not self.enabled:
+            return self.disabled_phase
+        return Phase(self, name)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def end_episode(self, episode):
+        """Summarize the phases of the episode, write the summary to the sink and start measuring the next episode
+
+        :param episode: the index of the episode
+        :return: the summary, mapping each phase to its wall time and number of calls
+        """
+        with self.lock:
+            summary = {name: {"seconds": self.seconds[name], "calls": self.calls[name]} for name in sorted(self.seconds)}
+            self.seconds, self.calls = {}, {}
+        if self.sink is not None:
+            with open(self.sink, "a") as sink_file:
+                sink_file.write(json.dumps({"episode": episode, "time": time.time(), "phases": summary}) + "\n")
+        return summary
+
+
+def format_profile(summary):
+    """Format an episode summary of a profiler for the log
+
+    :param summary: the summary as returned by Profiler.end_episode
+    :return: a line with the wall time and number of calls of each phase
+    """
+    return " ".join([name + " = " + str(round(phase["seconds"], 3)) + "s/" + str(phase["calls"])
+                     for name, phase in summary.items()])
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+# main.py imports keras and matplotlib at the top
+pytest.importorskip("keras")
+pytest.importorskip("matplotlib")
+from main import ExperienceReplay, Transition
+
+
+def fill(memory, num_transitions, episode_length=4):
+    # single pixel states holding the index of the transition, every episode_length-th transition is terminal
+    for idx in range(num_transitions):
+        game_over = (idx + 1) % episode_length == 0
+        preprocessed_next = [] if game_over else np.full((1, 1, 1, 1), idx + 1.0)
+        memory.remember(Transition(np.full((1, 1, 1, 1), float(idx)), idx % 5, float(idx), preprocessed_next), game_over)
+
+
+def get_records(memory):
+    records = []
+    for idx in range(len(memory)):
+        slot = memory.get_slots(idx)
+        start = memory.record_starts[slot]
+        transitions = memory.get_transitions(np.arange(start, start + memory.record_lengths[slot]))
+        records.append([int(transition.preprocessed_curr[0, 0, 0, 0]) for transition in transitions])
+    return records
+
+
+def test_oldest_records_are_evicted():
+    memory = ExperienceReplay(max_memory=10)
+    fill(memory, 25)
+    assert len(memory) == 10
+    assert get_records(memory) == [[idx] for idx in range(15, 25)]
+    ids, curr_states, actions, rewards, next_states, game_overs, weights = memory.sample_stacked_minibatch(32)
+    transition_idxs = np.array(ids)
+    assert np.array_equal(curr_states[:, 0, 0, 0], transition_idxs)
+    assert np.array_equal(actions, transition_idxs % 5)
+    assert np.array_equal(game_overs, (transition_idxs + 1) % 4 == 0)
+    assert np.array_equal(next_states[~game_overs, 0, 0, 0], transition_idxs[~game_overs] + 1)
+
+
+def test_episodes_are_stored_as_records():
+    # a record is closed by a terminal state, the newest one is still open
+    memory = ExperienceReplay(max_memory=3, store_episodes=True)
+    for idx in range(7):
+        game_over = idx % 3 == 2
+        memory.remember(Transition(np.full((1, 1, 1, 1), float(idx)), 0, 0.0, [] if game_over else np.zeros((1, 1, 1, 1))),
+                        game_over)
+    assert get_records(memory) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert memory.get_num_transitions() == 7
+
+
+def test_save_and_load_round_trip_with_priorities(tmpdir):
+    np.random.seed(0)
+    memory = ExperienceReplay(max_memory=12, prioritized=True)
+    fill(memory, 30)
+    ids, weights = memory.sample_indices(6)
+    memory.update_transition_priorities(memory.num_removed + ids, np.random.rand(6))
+    memory.save(str(tmpdir))
+
+    loaded = ExperienceReplay(max_memory=12, prioritized=True)
+    loaded.load(str(tmpdir))
+    assert get_records(loaded) == get_records(memory)
+    assert loaded.num_removed == memory.num_removed
+    assert loaded.get_gauges() == memory.get_gauges()
+    assert np.allclose(loaded.priorities.get(loaded.get_slots(np.arange(12))),
+                       memory.priorities.get(memory.get_slots(np.arange(12))))
+    assert np.isclose(loaded.priorities.total(), memory.priorities.total())
+    assert loaded.priorities.max() == memory.priorities.max()
+
+    # a smaller memory keeps the newest records and their priorities
+    smaller = ExperienceReplay(max_memory=5, prioritized=True)
+    smaller.load(str(tmpdir))
+    assert get_records(smaller) == get_records(memory)[-5:]
+    assert smaller.num_removed == memory.num_removed + 7
+    assert np.allclose(smaller.priorities.get(smaller.get_slots(np.arange(5))),
+                       memory.priorities.get(memory.get_slots(np.arange(7, 12))))
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+# main.py imports keras and matplotlib at the top
+pytest.importorskip("keras")
+pytest.importorskip("matplotlib")
+from main import FrameReplay, FrameStore, Transition
+
+history_length = 3
+
+
+def stack(frames, i):
+    # the state of the i-th step of an episode, padded with the first frame the same way the agent initializes it
+    return np.array([frames[max(j, 0)] for j in range(i - history_length + 1, i + 1)])[None]
+
+
+def play(replay, episodes):
+    """Store episodes of distinct single pixel frames
+
+    :param episodes: (length, truncated) pairs. a truncated episode is cut off after its last step, otherwise it ends
+                     in a terminal state
+    :return: the expected current and next states of each stored step, and the store's frame count after each step
+    """
+    expected = {}
+    frame = 0
+    for length, truncated in episodes:
+        frames = [np.full((1, 1), frame + i + 1) for i in range(length + 1)]
+        frame += length + 1
+        for i in range(length):
+            game_over = not truncated and i == length - 1
+            preprocessed_next = [] if game_over else stack(frames, i + 1)
+            expected[replay.num_stored] = (stack(frames, i), preprocessed_next)
+            transition = Transition(stack(frames, i), i % 3, float(i), preprocessed_next)
+            replay.remember(transition, game_over, truncated=truncated and i == length - 1)
+            yield expected
+
+
+def check_priorities(replay):
+    # exactly the steps which can be sampled have a priority
+    first, last = replay.get_sampling_range()
+    for slot in range(replay.max_memory):
+        step = replay.num_stored - 1 - (replay.num_stored - 1 - slot) % replay.max_memory
+        sampleable = first <= step <= last and not replay.store.truncations[slot]
+        assert (replay.priorities.get([slot])[0] > 0) == sampleable
+
+
+def test_states_are_rebuilt_across_wraps_and_episode_boundaries():
+    np.random.seed(0)
+    replay = FrameReplay(max_memory=7, history_length=history_length, frame_shape=(1, 1), frame_dtype=np.int64)
+    episodes = [(4, False), (3, True), (5, False), (2, True), (1, False), (6, False)]
+    for expected in play(replay, episodes):
+        first, last = replay.get_sampling_range()
+        if last < first:
+            continue
+        for step, transitions, game_over, weight in replay.sample_minibatch(32):
+            curr_state, next_state = expected[step]
+            assert not replay.store.truncations[step % replay.max_memory]
+            assert np.array_equal(transitions[0].preprocessed_curr, curr_state)
+            assert game_over == (len(next_state) == 0)
+            if not game_over:
+                assert np.array_equal(transitions[0].preprocessed_next, next_state)
+    assert replay.store.num_stored > 2 * replay.max_memory
+
+
+def test_shared_store_rebuilds_the_states_of_each_replay():
+    store = FrameStore(max_memory=9, frame_shape=(1, 1), frame_dtype=np.int64)
+    replays = [FrameReplay(history_length=history_length, frame_shape=(1, 1), frame_dtype=np.int64, frame_store=store)
+               for _ in range(2)]
+    episodes = [(5, True), (4, False), (6, True)]
+    # the replays store each step in turn, only the first one stores its frame
+    for expected in zip(play(replays[0], episodes), play(replays[1], episodes)):
+        pass
+    steps, curr_states, actions, rewards, next_states, game_overs, weights = replays[1].sample_stacked_minibatch(16)
+    for i, step in enumerate(steps):
+        curr_state, next_state = expected[1][step]
+        assert np.array_equal(curr_states[i:i+1], curr_state)
+        if not game_overs[i]:
+            assert np.array_equal(next_states[i:i+1], next_state)
+
+
+def test_prioritized_replay_samples_only_stored_transitions():
+    np.random.seed(1)
+    for max_memory, episodes in [(23, [(9, True), (7, False), (12, True), (5, False)]),
+                                 (9, [(4, False), (3, True), (8, False), (2, True), (6, False)])]:
+        replay = FrameReplay(max_memory=max_memory, history_length=history_length, frame_shape=(1, 1),
+                             frame_dtype=np.int64, prioritized=True)
+        for expected in play(replay, episodes):
+            check_priorities(replay)
+            first, last = replay.get_sampling_range()
+            if last < first:
+                continue
+            steps, weights = replay.sample_steps(8)
+            replay.update_transition_priorities(steps, np.random.rand(len(steps)))
+            check_priorities(replay)
+
+
+def test_save_and_load_round_trip(tmpdir):
+    replay = FrameReplay(max_memory=11, history_length=history_length, frame_shape=(1, 1), frame_dtype=np.int64,
+                         prioritized=True)
+    for expected in play(replay, [(6, False), (5, True), (7, False)]):
+        pass
+    steps, weights = replay.sample_steps(4)
+    replay.update_transition_priorities(steps, [0.1, 0.2, 0.3, 0.4])
+    replay.save(str(tmpdir))
+    loaded = FrameReplay(max_memory=11, history_length=history_length, frame_shape=(1, 1), frame_dtype=np.int64,
+                         prioritized=True)
+    loaded.load(str(tmpdir))
+    assert loaded.num_stored == replay.num_stored
+    assert loaded.get_sampling_range() == replay.get_sampling_range()
+    assert np.array_equal(loaded.priorities.sums, replay.priorities.sums)
+    for name in ["frames", "game_overs", "truncations", "episode_starts"]:
+        assert np.array_equal(getattr(loaded.store, name), getattr(replay.store, name))
+    first, last = loaded.get_sampling_range()
+    steps = np.arange(first, last + 1)
+    assert np.array_equal(loaded.store.get_states(steps, history_length), replay.store.get_states(steps, history_length))
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+# main.py imports keras and matplotlib at the top
+pytest.importorskip("keras")
+pytest.importorskip("matplotlib")
+from main import SumTree
+
+
+def test_update_keeps_the_sums_and_maxs_of_the_leaves():
+    tree = SumTree(13)
+    values = np.random.RandomState(0).rand(13)
+    tree.update(np.arange(13), values)
+    # a batch of few leaves goes through the path update, a batch of many leaves through the level update
+    tree.update([3, 7], [0.5, 2.5])
+    values[[3, 7]] = [0.5, 2.5]
+    tree.update([11], 0)
+    values[11] = 0
+    assert np.isclose(tree.total(), np.sum(values))
+    assert tree.max() == np.max(values)
+    assert np.allclose(tree.get(np.arange(13)), values)
+
+
+def test_path_update_matches_level_update():
+    capacity = 37
+    values = np.random.RandomState(1).rand(capacity)
+    by_path, by_level = SumTree(capacity), SumTree(capacity)
+    for leaf in range(capacity):
+        by_path.update([leaf], values[leaf])
+    by_level.update(np.arange(capacity), values)
+    assert np.array_equal(by_path.sums, by_level.sums)
+    assert np.array_equal(by_path.maxs, by_level.maxs)
+
+
+def test_find_returns_the_leaf_of_each_prefix_sum():
+    tree = SumTree(5)
+    tree.update(np.arange(5), [1, 0, 2, 0, 1])
+    assert list(tree.find([0, 0.99, 1, 2.5, 3, 3.99])) == [0, 0, 2, 2, 4, 4]
+
+
+def test_sample_is_proportional_to_the_values():
+    np.random.seed(0)
+    values = np.array([1, 0, 2, 4, 0, 1], dtype=np.float64)
+    tree = SumTree(len(values))
+    tree.update(np.arange(len(values)), values)
+    counts = np.zeros(len(values))
+    for _ in range(500):
+        counts += np.bincount(tree.sample(32), minlength=len(values))
+    assert counts[1] == 0 and counts[4] == 0
+    assert np.allclose(counts / np.sum(counts), values / np.sum(values), atol=0.01)